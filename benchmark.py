@@ -0,0 +1,693 @@
+#!/usr/local/bin/python
+#
+# (C) 2024, Tiago Gasiba
+#           tiago.gasiba@gmail.com
+#
+# Performance benchmarks for cache2repo / repo2repo
+#
+#   ./benchmark.py -b formats -n 30000
+#   ./benchmark.py -b cache2repo -n 1000,10000,50000 -s 4096
+#   ./benchmark.py -b repo2repo -n 1000,10000 -l 5 -o report.json
+#   ./benchmark.py -b failover -n 1000 -f 0.3
+#   ./benchmark.py -b check -n 1000,30000
+#
+import http.server
+import subprocess
+import threading
+import socket
+import sqlite3
+import hashlib
+import tempfile
+import shutil
+import getopt
+import fnmatch
+import lzma
+import random
+import re
+import glob
+import json
+import time
+import sys
+import os
+
+import cache2repo
+import repo2repo
+import mirrorlib
+from mirrorlib import maxRSS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RED    = "\033[0;31m"
+YELLOW = "\033[1;33m"
+WHITE  = "\033[1;37m"
+GREEN  = "\033[0;32m"
+BLUE   = "\033[0;34m"
+RESET  = "\033[0m"
+
+g_dbSchema = """
+CREATE TABLE packages (id INTEGER PRIMARY KEY, origin TEXT NOT NULL, name TEXT NOT NULL, version TEXT NOT NULL,
+                       comment TEXT NOT NULL, desc TEXT NOT NULL, message TEXT, arch TEXT NOT NULL,
+                       maintainer TEXT NOT NULL, www TEXT, prefix TEXT NOT NULL, flatsize INTEGER NOT NULL,
+                       automatic INTEGER NOT NULL DEFAULT 0, locked INTEGER NOT NULL DEFAULT 0,
+                       licenselogic INTEGER NOT NULL, time INTEGER, manifestdigest TEXT, pkg_format_version INTEGER,
+                       dep_formula TEXT, vital INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE licenses (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE shlibs (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE option (option_id INTEGER PRIMARY KEY, option TEXT NOT NULL UNIQUE);
+CREATE TABLE annotation (annotation_id INTEGER PRIMARY KEY, annotation TEXT NOT NULL UNIQUE);
+CREATE TABLE groups (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE deps (origin TEXT NOT NULL, name TEXT NOT NULL, version TEXT NOT NULL,
+                   package_id INTEGER REFERENCES packages(id) ON DELETE CASCADE, UNIQUE(package_id, name));
+CREATE TABLE pkg_licenses (package_id INTEGER REFERENCES packages(id), license_id INTEGER REFERENCES licenses(id),
+                           UNIQUE(package_id, license_id));
+CREATE TABLE pkg_categories (package_id INTEGER REFERENCES packages(id), category_id INTEGER REFERENCES categories(id),
+                             UNIQUE(package_id, category_id));
+CREATE TABLE pkg_shlibs_required (package_id INTEGER REFERENCES packages(id), shlib_id INTEGER REFERENCES shlibs(id),
+                                  UNIQUE(package_id, shlib_id));
+CREATE TABLE pkg_shlibs_provided (package_id INTEGER REFERENCES packages(id), shlib_id INTEGER REFERENCES shlibs(id),
+                                  UNIQUE(package_id, shlib_id));
+CREATE TABLE pkg_option (package_id INTEGER REFERENCES packages(id), option_id INTEGER REFERENCES option(option_id),
+                         value TEXT NOT NULL, PRIMARY KEY(package_id, option_id));
+CREATE TABLE pkg_annotation (package_id INTEGER REFERENCES packages(id), tag_id INTEGER REFERENCES annotation(annotation_id),
+                             value_id INTEGER REFERENCES annotation(annotation_id), UNIQUE(package_id, tag_id));
+CREATE TABLE pkg_groups (package_id INTEGER REFERENCES packages(id), group_id INTEGER REFERENCES groups(id),
+                         UNIQUE(package_id, group_id));
+CREATE TABLE pkg_users (package_id INTEGER REFERENCES packages(id), user_id INTEGER REFERENCES users(id),
+                        UNIQUE(package_id, user_id));
+"""
+
+def syntheticDeps( i, nPackages ):
+    # the first sixth of the packages are libraries that mostly depend on
+    # each other, and popular ones sit at the low indices, which keeps
+    # closures in the tens of packages like in the ports tree
+    libraries = max(nPackages // 6, 1)
+    if i < libraries:
+        deps = [ int(i * random.random()**4) for d in range(random.randint(0, 3)) ]
+    else:
+        deps = [ int(libraries * random.random()**2) for d in range(random.randint(0, 8)) ]
+    return sorted(set([ d for d in deps if d != i ]))
+
+def syntheticPackage( i, nPackages ):
+    # roughly the shape and size of a real packagesite.yaml entry; libraries
+    # provide a shared library that their dependents require
+    name = f"pkg{i}"
+    deps = syntheticDeps(i, nPackages)
+    libraries = max(nPackages // 6, 1)
+    package = { "name"            : name,
+                "origin"          : f"category{i%60}/{name}",
+                "version"         : f"{i%7}.{i%13}.{i%5}",
+                "comment"         : f"Synthetic package number {i} used for benchmarking",
+                "maintainer"      : "ports@FreeBSD.org",
+                "www"             : f"https://example.org/{name}",
+                "abi"             : "FreeBSD:14:amd64",
+                "arch"            : "freebsd:14:x86:64",
+                "prefix"          : "/usr/local",
+                "sum"             : "%064x" % random.getrandbits(256),
+                "flatsize"        : random.randint(1000, 50000000),
+                "path"            : f"All/{name}.pkg",
+                "repopath"        : f"All/{name}.pkg",
+                "licenselogic"    : "single",
+                "licenses"        : [ "BSD2CLAUSE" ],
+                "pkgsize"         : random.randint(1000, 20000000),
+                "desc"            : " ".join([ "lorem ipsum dolor sit amet" ] * random.randint(5, 40)),
+                "deps"            : { f"pkg{d}": { "origin": f"category{d%60}/pkg{d}", "version": f"{d%7}.{d%13}.{d%5}" }
+                                      for d in deps },
+                "shlibs_required" : [ f"libpkg{d}.so.{d%4}" for d in deps if d < libraries ],
+                "shlibs_provided" : [ f"libpkg{i}.so.{i%4}" ] if i < libraries else [],
+                "categories"      : [ f"category{i%60}" ],
+                "annotations"     : { "FreeBSD_version": "1400097", "build_timestamp": "2024-01-01T00:00:00+0000" },
+              }
+    return package
+
+def syntheticManifestLine( i, nPackages ):
+    return json.dumps(syntheticPackage(i, nPackages)).encode()
+
+def syntheticFileSize( averageSize ):
+    return random.randint(averageSize // 2, averageSize + averageSize // 2)
+
+def timeIt( fn, rounds ):
+    best = None
+    for r in range(rounds):
+        startTime = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - startTime
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+def decompressArchive( archiveName ):
+    # what a pkg client does with the catalogue: libarchive via bsdtar
+    if shutil.which("bsdtar") is not None:
+        subprocess.run(["bsdtar", "-xOf", archiveName, "packagesite.yaml"], stdout=subprocess.DEVNULL, check=True)
+    else:
+        fmt = archiveName.rsplit(".", 1)[-1]
+        tool = { "txz": "xz", "tzst": "zstd" }[fmt]
+        if shutil.which(tool) is not None:
+            subprocess.run(f"{tool} -dc {archiveName} > /dev/null", shell=True, check=True)
+        else:
+            # same in-process fallbacks the catalogue writer uses
+            with open(archiveName, "rb") as fIn:
+                if fmt == "txz":
+                    reader = lzma.LZMAFile(fIn, "rb")
+                else:
+                    reader = zstandard.ZstdDecompressor().stream_reader(fIn)
+                while reader.read(1024*1024):
+                    pass
+
+def benchFormats( nPackages, rounds ):
+    print(f"{WHITE}Generating {nPackages} synthetic manifest lines...{RESET}")
+    lines = [ syntheticManifestLine(i, nPackages) for i in range(nPackages) ]
+    rawSize = sum([ len(l) + 1 for l in lines ])
+    workDir = tempfile.mkdtemp(prefix="benchmark.")
+    print("")
+    print(f"{WHITE}{'format':8s} {'size MiB':>10s} {'ratio':>7s} {'build s':>9s} {'decompress s':>13s}{RESET}")
+    try:
+        for fmt in ("txz", "tzst"):
+            try:
+                mirrorlib.checkPackingFormat(fmt)
+            except mirrorlib.MirrorError as e:
+                print(f"{fmt:8s} {YELLOW}skipped{RESET}: {e}")
+                continue
+            archiveName = workDir + "/packagesite." + fmt
+            buildTime = timeIt(lambda: mirrorlib.writeCatalogueArchive(archiveName, lines, fmt), rounds)
+            size = os.path.getsize(archiveName)
+            readTime = timeIt(lambda: decompressArchive(archiveName), rounds)
+            print(f"{fmt:8s} {size/(1024*1024):10.2f} {rawSize/size:7.2f} {buildTime:9.3f} {readTime:13.3f}")
+    finally:
+        shutil.rmtree(workDir)
+    print("")
+
+def runIsolated( fn, *args ):
+    # Every measurement runs in a forked child, so the peak RSS reported is
+    # that run's own and nothing is left cached in the parent. The child's
+    # output is discarded and its result comes back as JSON over a pipe.
+    sys.stdout.flush()
+    rd, wr = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rd)
+        devNull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devNull, 1)
+        try:
+            result = fn(*args)
+            result["peakRSS"] = maxRSS()
+        except BaseException as e:
+            result = { "error": f"{type(e).__name__}: {e}" }
+        with os.fdopen(wr, "wb") as f:
+            f.write(json.dumps(result).encode())
+        os._exit(0)
+    os.close(wr)
+    with os.fdopen(rd, "rb") as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+def timed( phases, name, fn, *args ):
+    startTime = time.perf_counter()
+    result = fn(*args)
+    phases[name] = time.perf_counter() - startTime
+    return result
+
+def buildLocalDB( dbFile, nPackages ):
+    # the tables and columns of pkg(8)'s local.sqlite that cache2repo reads,
+    # with link rows in roughly the proportions of a real system
+    cx = sqlite3.connect(dbFile)
+    cu = cx.cursor()
+    cu.executescript(g_dbSchema)
+    for table in ("licenses", "categories", "shlibs", "groups", "users"):
+        cu.executemany(f"INSERT INTO {table} VALUES (?,?)", [ (i, f"{table}{i}") for i in range(1, 201) ])
+    cu.executemany("INSERT INTO option VALUES (?,?)", [ (i, f"OPTION{i}") for i in range(1, 201) ])
+    cu.executemany("INSERT INTO annotation VALUES (?,?)", [ (i, f"annotation{i}") for i in range(1, 201) ])
+    packages = []
+    deps = []
+    links = { "pkg_licenses": [], "pkg_categories": [], "pkg_shlibs_required": [], "pkg_shlibs_provided": [],
+              "pkg_groups": [], "pkg_users": [], "pkg_option": [], "pkg_annotation": [] }
+    for i in range(nPackages):
+        p = syntheticPackage(i, nPackages)
+        packageID = i + 1
+        packages.append((packageID, p["origin"], p["name"], p["version"], p["comment"], p["desc"],
+                         "" if i % 10 else "Post-install message", p["abi"], p["maintainer"], p["www"],
+                         p["prefix"], p["flatsize"], random.choice([ 1, 38, 124 ])))
+        for d, dep in p["deps"].items():
+            deps.append((dep["origin"], d, dep["version"], packageID))
+        for table, n in (("pkg_licenses", 2), ("pkg_categories", 2), ("pkg_shlibs_required", 12),
+                         ("pkg_shlibs_provided", 3), ("pkg_groups", 1), ("pkg_users", 1)):
+            for x in random.sample(range(1, 201), random.randint(0, n)):
+                links[table].append((packageID, x))
+        for x in random.sample(range(1, 201), random.randint(0, 10)):
+            links["pkg_option"].append((packageID, x, random.choice([ "on", "off" ])))
+        for x in random.sample(range(1, 201), random.randint(2, 6)):
+            links["pkg_annotation"].append((packageID, x, random.randint(1, 200)))
+    cu.executemany("INSERT INTO packages (id, origin, name, version, comment, desc, message, arch, maintainer, www, prefix, flatsize, licenselogic) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", packages)
+    cu.executemany("INSERT INTO deps VALUES (?,?,?,?)", deps)
+    for table, rows in links.items():
+        cu.executemany(f"INSERT INTO {table} VALUES ({','.join(['?']*len(rows[0]))})", rows)
+    cx.commit()
+    cx.close()
+
+def buildPackageCache( cacheDir, nPackages, averageSize ):
+    # pkg(8)'s cache layout: name-version~hash.pkg with a name-version.pkg
+    # symlink pointing at it
+    os.makedirs(cacheDir)
+    for i in range(nPackages):
+        p = syntheticPackage(i, nPackages)
+        data = random.randbytes(syntheticFileSize(averageSize))
+        fileName = f"{p['name']}-{p['version']}~{hashlib.sha256(data).hexdigest()[:10]}.pkg"
+        with open(cacheDir + "/" + fileName, "wb") as f:
+            f.write(data)
+        os.symlink(fileName, f"{cacheDir}/{p['name']}-{p['version']}.pkg")
+
+def benchCache2repo( nPackages, averageSize ):
+    workDir = tempfile.mkdtemp(prefix="benchmark.")
+    try:
+        random.seed(nPackages)
+        buildLocalDB(workDir + "/local.sqlite", nPackages)
+        buildPackageCache(workDir + "/cache", nPackages, averageSize)
+        cacheDir = workDir + "/cache"
+        outputDir = workDir + "/mirror"
+        os.makedirs(outputDir)
+        cache2repo.g_checkSumCacheFile = workDir + "/checksums.json"
+        pkgFiles = [ f for f in glob.glob(f"{cacheDir}/*.pkg") if "~" not in os.path.basename(f) ]
+        phases = {}
+        (conn, cursor) = timed(phases, "openLocalDB", cache2repo.openLocalDB, workDir + "/local.sqlite")
+        timed(phases, "loadGlobalVars", cache2repo.loadGlobalVars, cursor)
+        timed(phases, "computeDeps", cache2repo.computeDeps, cursor)
+        timed(phases, "loadLinks", cache2repo.loadLinks, cursor)
+        timed(phases, "checksums (uncached)", cache2repo.computeCheckSums, pkgFiles)
+        timed(phases, "checksums (cached)", cache2repo.computeCheckSums, pkgFiles)
+        repoPackages = timed(phases, "loadPackages", cache2repo.loadPackages, cursor, cacheDir)
+        conn.close()
+        (selected, artifacts) = timed(phases, "selectPackages", cache2repo.selectPackages, repoPackages, cacheDir)
+        timed(phases, "copyPackages", cache2repo.copyPackages, artifacts, outputDir)
+        lines = [ json.dumps(p).encode() for p in selected ]
+        timed(phases, "writeCatalogue", mirrorlib.writeCatalogue, outputDir, lines, "txz")
+        return { "phases": phases, "counts": { "packages": len(selected) } }
+    finally:
+        shutil.rmtree(workDir)
+
+class LatencyHandler( http.server.SimpleHTTPRequestHandler ):
+    # static files with a fixed delay before every response; a share of the
+    # responses can be made to fail the ways a bad mirror does: a 5xx, a
+    # connection dropped before the reply, or a body cut off halfway
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    failureRate = 0.0
+
+    def log_message( self, *args ):
+        pass
+
+    def do_GET( self ):
+        time.sleep(self.latency)
+        if random.random() >= self.failureRate:
+            super().do_GET()
+            return
+        failure = random.choice([ "error", "drop", "truncate" ])
+        if failure == "error":
+            self.send_error(503)
+        elif failure == "truncate":
+            f = self.send_head()
+            if f is not None:
+                with f:
+                    data = f.read()
+                    self.wfile.write(data[:len(data) // 2])
+        self.close_connection = True
+
+def serveRepository( rootDir, latency, failureRate=0.0 ):
+    handler = type("Handler", (LatencyHandler,), { "latency": latency, "failureRate": failureRate })
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), lambda *args: handler(*args, directory=rootDir))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, f"http://127.0.0.1:{server.server_address[1]}")
+
+def deadMirror():
+    # a port nothing listens on: every connection is refused
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+def buildRepository( rootDir, nPackages, averageSize ):
+    # packagesite.txz plus an All/ tree whose files match the manifest sums
+    os.makedirs(rootDir + "/All")
+    lines = []
+    for i in range(nPackages):
+        p = syntheticPackage(i, nPackages)
+        data = random.randbytes(syntheticFileSize(averageSize))
+        with open(rootDir + "/" + p["repopath"], "wb") as f:
+            f.write(data)
+        p["pkgsize"] = len(data)
+        p["sum"] = hashlib.sha256(data).hexdigest()
+        lines.append(json.dumps(p).encode())
+    mirrorlib.writeCatalogueArchive(rootDir + "/packagesite.txz", lines, "txz")
+
+def benchRepo2repo( nPackages, averageSize, latency ):
+    workDir = tempfile.mkdtemp(prefix="benchmark.")
+    try:
+        random.seed(nPackages)
+        buildRepository(workDir + "/server", nPackages, averageSize)
+        (server, url) = serveRepository(workDir + "/server", latency)
+        repoDir = workDir + "/repo"
+        os.makedirs(repoDir)
+        config = repo2repo.MirrorConfig([ url ], catalogueCacheDir=workDir + "/catalogue", quiet=True)
+        phases = {}
+        allPkg = timed(phases, "catalogue (uncached)", repo2repo.loadCatalogue, url + "/packagesite.txz", None, config.catalogueCacheDir)
+        allPkg = timed(phases, "catalogue (cached)", repo2repo.loadCatalogue, url + "/packagesite.txz", None, config.catalogueCacheDir)
+        depIndex = timed(phases, "buildDepIndex", repo2repo.buildDepIndex, allPkg)
+        wanted = random.sample(sorted(allPkg), max(nPackages // 10, 1))
+        rules = wanted + [ f"pkg{i}*" for i in range(1, 100) ] + [ f"origin:category{i}/*" for i in range(0, 60, 7) ] + [ "!category:category1" ]
+        timed(phases, "select", repo2repo.SelectionRules(rules).select, allPkg)
+        (closure, unknown) = timed(phases, "resolveClosure", repo2repo.resolveClosure, wanted, depIndex)
+        shlibIndex = timed(phases, "ShlibIndex", repo2repo.ShlibIndex, allPkg)
+        timed(phases, "resolveClosure (shlibs)", repo2repo.resolveClosure, wanted, depIndex, shlibIndex)
+        timed(phases, "unsatisfied (catalogue)", shlibIndex.unsatisfied, list(allPkg))
+        synced = timed(phases, "download", repo2repo.syncPackages, allPkg, list(closure), repoDir, config)
+        timed(phases, "sync (up to date)", repo2repo.syncPackages, allPkg, list(closure), repoDir, config)
+        timed(phases, "writeCatalogue", mirrorlib.writeCatalogue, repoDir, [ allPkg[p].line for p in synced ], "txz")
+        server.shutdown()
+        return { "phases": phases, "counts": { "packages": len(synced), "bytes": sum([ allPkg[p].pkgsize for p in synced ]) } }
+    finally:
+        shutil.rmtree(workDir)
+
+def benchFailover( nPackages, averageSize, latency, failureRate ):
+    # A dead mirror, a flaky one and a good one: the mirror must still come
+    # out complete, with every file matching its catalogue sum.
+    workDir = tempfile.mkdtemp(prefix="benchmark.")
+    try:
+        random.seed(nPackages)
+        buildRepository(workDir + "/server", nPackages, averageSize)
+        (server, url) = serveRepository(workDir + "/server", latency)
+        (flakyServer, flakyURL) = serveRepository(workDir + "/server", latency, failureRate)
+        repoDir = workDir + "/repo"
+        os.makedirs(repoDir)
+        repo2repo.g_backoffBase = 0.05
+        config = repo2repo.MirrorConfig([ deadMirror(), flakyURL, url ], catalogueCacheDir=workDir + "/catalogue", quiet=True)
+        phases = {}
+        allPkg = repo2repo.loadCatalogue(url + "/packagesite.txz", cacheDir=config.catalogueCacheDir)
+        synced = timed(phases, "download (failover)", repo2repo.syncPackages, allPkg, list(allPkg), repoDir, config)
+        flakyServer.shutdown()
+        server.shutdown()
+        missing = [ p for p in allPkg if p not in synced ]
+        corrupt = [ p for p in synced if repo2repo.computeCheckSum(repoDir + "/" + allPkg[p].repopath) != allPkg[p].sum ]
+        result = { "phases": phases, "counts": { "packages": len(synced), "missing": len(missing), "corrupt": len(corrupt),
+                                                 "mirrors": [ [ m["url"], m["ok"], m["failed"] ] for m in config.mirrors.mirrors ] } }
+        if (missing != []) or (corrupt != []):
+            result["error"] = f"{len(missing)} packages missing, {len(corrupt)} corrupt after failover"
+        return result
+    finally:
+        shutil.rmtree(workDir)
+
+def syntheticCatalogue( nPackages ):
+    # the synthetic manifest lines as repo2repo reads them, every fifth
+    # package with a flavor, plus the pkg package every volume carries
+    allPkg = {}
+    for i in range(nPackages):
+        p = syntheticPackage(i, nPackages)
+        if i % 5 == 0:
+            p["annotations"]["flavor"] = f"py3{i%4}"
+        allPkg[p["name"]] = repo2repo.PkgRecord(json.dumps(p).encode())
+    p = syntheticPackage(0, nPackages)
+    p["name"] = "pkg"
+    allPkg["pkg"] = repo2repo.PkgRecord(json.dumps(p).encode())
+    return allPkg
+
+def syntheticRules( nPackages, nRules ):
+    # every kind of term SelectionRules indexes differently, alone, combined
+    # and as exclusions
+    def term():
+        i = random.randrange(nPackages)
+        return random.choice([ f"pkg{i}", f"nosuch{i}", f"pkg{i//10}*", f"*{i%100}", f"*g{i%10}*", f"pkg[12]?{i%10}",
+                               f"~pkg{i%10}[0-9]{{2}}", f"origin:category{i%60}/*", f"origin:category{i%6}?/pkg{i%7}*",
+                               f"category:category{i%60}", f"category:*{i%10}", f"flavor:py3{i%4}", f"flavor:~py3[01]",
+                               f"name:pkg{i%100}*", f"name:pkg{i}" ])
+    rules = []
+    for n in range(nRules):
+        line = " ".join([ term() for t in range(random.choice([ 1, 1, 1, 2, 3 ])) ])
+        if random.random() < 0.2:
+            line = "!" + line
+        rules.append(line)
+    return rules
+
+def bruteForceSelect( rules, allPkg ):
+    # SelectionRules.select() evaluated term by term on every package
+    def termMatches( text, pkg ):
+        field, sep, value = text.partition(":")
+        if sep == "":
+            field, value = "name", text
+        values = { "name": [ pkg.name ], "origin": [ pkg.origin ] if pkg.origin != "" else [],
+                   "flavor": [ pkg.flavor ] if pkg.flavor != "" else [], "category": pkg.categories }[field]
+        for v in values:
+            if value.startswith("~"):
+                if re.fullmatch(value[1:], v): return True
+            elif [ c for c in value if c in "*?[" ] != []:
+                if fnmatch.fnmatchcase(v, value): return True
+            elif v == value:
+                return True
+        return False
+    selected = []
+    used = set()
+    for name, pkg in allPkg.items():
+        matching = []
+        for rule, line in enumerate(rules):
+            terms = line[1:].split() if line.startswith("!") else line.split()
+            if all([ termMatches(t, pkg) for t in terms ]):
+                matching.append(rule)
+        used.update(matching)
+        includes = [ rule for rule in matching if not rules[rule].startswith("!") ]
+        if (includes != []) and (len(includes) == len(matching)):
+            selected.append((min(includes), name))
+    unmatched = []
+    for rule, line in enumerate(rules):
+        if rule in used:
+            continue
+        plain = (not line.startswith(("!", "~"))) and (len(line.split()) == 1) and (":" not in line) and \
+                ([ c for c in line if c in "*?[" ] == [])
+        if plain:
+            selected.append((rule, line))
+        else:
+            unmatched.append(line)
+    selected.sort()
+    return ([ name for rule, name in selected ], unmatched)
+
+def checkVersions():
+    # the order cache2repo's pkgVersionKey documents: numbers compare
+    # numerically, letters sort below numbers, then the port revision, and
+    # the epoch before everything
+    ordered = [ "0.9", "1.0", "1.0a", "1.0b", "1.0.1", "1.0.1_1", "1.0.1_2", "1.0.2", "1.2", "1.9", "1.10", "1.10.0.1",
+                "2.0.b1", "2.0.1", "10.0", "0.1,1", "0.2,1", "0.2_3,1", "0.1,2" ]
+    failed = []
+    for i, a in enumerate(ordered):
+        for b in ordered[i+1:]:
+            if not (cache2repo.pkgVersionKey(a) < cache2repo.pkgVersionKey(b)):
+                failed.append(f"{a} < {b}")
+    shuffled = ordered[:]
+    random.shuffle(shuffled)
+    if sorted(shuffled, key=cache2repo.pkgVersionKey) != ordered:
+        failed.append("sorting a shuffled list")
+    return failed
+
+def checkVolumes( allPkg, volumes, split, pkgNames, capacity, shlibIndex ):
+    # every package placed; no package needs a dependency from a later
+    # volume; volumes of closures that were not spread are closed under
+    # dependencies; every volume fits
+    failed = []
+    members = set(pkgNames)
+    firstVolume = {}
+    for n, names in enumerate(volumes):
+        for p in names:
+            firstVolume.setdefault(p, n)
+    if set(firstVolume) != members:
+        failed.append(f"{len(members - set(firstVolume))} packages not placed")
+    spread = set()
+    if split != []:
+        spread.update(repo2repo.resolveClosure(split, repo2repo.buildDepIndex(allPkg), shlibIndex)[0])
+    for n, names in enumerate(volumes):
+        present = set(names)
+        for p in names:
+            deps = [ d for d in allPkg[p].deps if d in members ]
+            if shlibIndex is not None:
+                deps += shlibIndex.edges(p, members)
+            for d in deps:
+                if firstVolume[d] > n:
+                    failed.append(f"volume {n+1}: {p} needs {d} from volume {firstVolume[d]+1}")
+                elif (d not in present) and (p not in spread):
+                    failed.append(f"volume {n+1}: {p} without {d}")
+        if repo2repo.estimateISOSize(allPkg, names) > capacity:
+            failed.append(f"volume {n+1}: {repo2repo.estimateISOSize(allPkg, names)} bytes of {capacity}")
+    return failed
+
+def benchCheck( nPackages ):
+    # Correctness claims made elsewhere, checked on synthetic data: the
+    # selection rules against a brute-force evaluation, the version order
+    # and the volume layout. Timings of the checked calls are reported.
+    random.seed(nPackages)
+    phases = {}
+    failed = []
+    allPkg = syntheticCatalogue(nPackages)
+    names = list(allPkg)
+    rules = syntheticRules(nPackages, min(200, nPackages // 5))
+    selection = timed(phases, "SelectionRules", repo2repo.SelectionRules(rules).select, allPkg)
+    if selection != bruteForceSelect(rules, allPkg):
+        failed.append("selection differs from the brute-force evaluation")
+    failed += checkVersions()
+    shlibIndex = repo2repo.ShlibIndex(allPkg)
+    largest = max([ repo2repo.volumeCost(p) for p in allPkg.values() ])
+    for label, roots in (("all roots", names), ("10% roots", random.sample(names, max(nPackages // 10, 1)))):
+        # DVD-sized volumes, and volumes so small that closures get spread
+        for capacity in (4480*1024*1024, repo2repo.estimateISOSize(allPkg, []) + 4*largest):
+            for shlibs in (None, shlibIndex):
+                startTime = time.perf_counter()
+                (volumes, split) = repo2repo.splitVolumes(allPkg, names, roots, capacity, shlibs)
+                if (capacity == 4480*1024*1024) and (shlibs is None):
+                    phases[f"splitVolumes ({label})"] = time.perf_counter() - startTime
+                failed += checkVolumes(allPkg, volumes, split, names, capacity, shlibs)
+    result = { "phases": phases, "counts": { "rules": len(rules), "selected": len(selection[0]), "failed": len(failed) } }
+    if failed != []:
+        result["error"] = f"{len(failed)} checks failed: " + "; ".join(failed[:5])
+    return result
+
+def printReport( results ):
+    # one column per catalogue size, one row per phase
+    sizes = [ r["packages"] for r in results ]
+    phases = []
+    for r in results:
+        for name in r.get("phases", {}):
+            if name not in phases:
+                phases.append(name)
+    print("")
+    print(f"{WHITE}{'phase':24s}" + "".join([ f"{n:>12d}" for n in sizes ]) + f"{RESET}")
+    for name in phases:
+        print(f"{name:24s}" + "".join([ f"{r['phases'][name]:11.3f}s" if name in r.get("phases", {}) else f"{'-':>12s}" for r in results ]))
+    print(f"{'peak RSS (MiB)':24s}" + "".join([ f"{r['peakRSS']/(1024*1024):12.1f}" if "peakRSS" in r else f"{'-':>12s}" for r in results ]))
+    for r in results:
+        if "error" in r:
+            print(f"{RED}ERROR{RESET}: {r['packages']} packages: {r['error']}")
+    print("")
+
+def compareReport( results, baselineFile, tolerance ):
+    # phases that got slower than the baseline run by more than tolerance
+    with open(baselineFile, "r") as f:
+        baseline = { r["packages"]: r for r in json.load(f)["results"] }
+    regressions = 0
+    for r in results:
+        base = baseline.get(r["packages"])
+        if base is None: continue
+        for name, elapsed in r.get("phases", {}).items():
+            before = base.get("phases", {}).get(name)
+            if (before is None) or (before < 0.01): continue
+            if elapsed > before * (1 + tolerance):
+                regressions += 1
+                print(f"{RED}SLOWER{RESET}: {name} with {r['packages']} packages: {before:.3f}s -> {elapsed:.3f}s ({elapsed/before:.2f}x)")
+        if ("peakRSS" in r) and ("peakRSS" in base) and (r["peakRSS"] > base["peakRSS"] * (1 + tolerance)):
+            regressions += 1
+            print(f"{RED}LARGER{RESET}: peak RSS with {r['packages']} packages: {base['peakRSS']/(1024*1024):.1f} -> {r['peakRSS']/(1024*1024):.1f} MiB")
+    if regressions == 0:
+        print(f"{GREEN}No regressions against{RESET}: {baselineFile}")
+    return regressions
+
+def usage():
+    print("")
+    print("benchmark: performance benchmarks for cache2repo / repo2repo")
+    print("")
+    print("  -b <name>      : benchmark to run:")
+    print("                     formats    : catalogue packing formats, size and speed")
+    print("                     cache2repo : every phase against a synthetic local.sqlite")
+    print("                                  and /var/cache/pkg")
+    print("                     repo2repo  : catalogue, closure and download phases against")
+    print("                                  a synthetic repository served over local HTTP")
+    print("                     failover   : mirrors a synthetic repository through a dead, a")
+    print("                                  flaky and a good mirror and checks the result")
+    print("                     check      : checks selection rules against a brute-force")
+    print("                                  evaluation, the package version order and the")
+    print("                                  volume layout, and times them")
+    print("  -n <packages>  : number of synthetic packages, comma separated list")
+    print("                   (default=30000 for formats, 1000,10000,50000 otherwise)")
+    print("  -s <bytes>     : average size of a synthetic package file (default=4096)")
+    print("  -l <ms>        : latency added to every HTTP response (default=5)")
+    print("  -f <rate>      : share of failed responses from the flaky mirror (default=0.3)")
+    print("  -r <rounds>    : rounds per measurement, best is reported (default=3)")
+    print("  -o <file>      : also write the results as JSON")
+    print("  -c <file>      : compare against the JSON results of an earlier run; exits")
+    print("                   with status 1 when a phase is more than 25% slower")
+    print("")
+    print("  A run that fails, e.g. a failover run that leaves files missing or corrupt,")
+    print("  exits with status 1.")
+    print("")
+    exit(0)
+
+def main():
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+
+    benchmark = "formats"
+    sizes = None
+    averageSize = 4096
+    latency = 5
+    failureRate = 0.3
+    rounds = 3
+    reportFile = None
+    baselineFile = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hb:n:r:s:l:f:o:c:")
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+    for o, a in opts:
+        if   o in ("-b"): benchmark = a
+        elif o in ("-n"): sizes = [ int(n) for n in a.split(",") ]
+        elif o in ("-r"): rounds = int(a)
+        elif o in ("-s"): averageSize = int(a)
+        elif o in ("-l"): latency = float(a)
+        elif o in ("-f"): failureRate = float(a)
+        elif o in ("-o"): reportFile = a
+        elif o in ("-c"): baselineFile = a
+        elif o in ("-h"): usage()
+        else:
+            assert False, "unhandled option"
+
+    random.seed(0)
+    results = []
+    if benchmark == "formats":
+        for nPackages in (sizes or [ 30000 ]):
+            benchFormats(nPackages, rounds)
+    elif benchmark in ("cache2repo", "repo2repo", "failover", "check"):
+        for nPackages in (sizes or [ 1000, 10000, 50000 ]):
+            print(f"{WHITE}Running {benchmark} with {nPackages} packages...{RESET}")
+            if benchmark == "cache2repo":
+                result = runIsolated(benchCache2repo, nPackages, averageSize)
+            elif benchmark == "repo2repo":
+                result = runIsolated(benchRepo2repo, nPackages, averageSize, latency/1000)
+            elif benchmark == "check":
+                result = runIsolated(benchCheck, nPackages)
+            else:
+                result = runIsolated(benchFailover, nPackages, averageSize, latency/1000, failureRate)
+            result["packages"] = nPackages
+            results.append(result)
+        printReport(results)
+    else:
+        print(f"{RED}ERROR{RESET}: unknown benchmark {benchmark}")
+        exit(0)
+
+    if reportFile is not None:
+        with open(reportFile, "w") as f:
+            json.dump({ "benchmark": benchmark, "averageSize": averageSize, "latency": latency,
+                        "time": int(time.time()), "results": results }, f, indent=1)
+
+    if (baselineFile is not None) and (compareReport(results, baselineFile, 0.25) > 0):
+        exit(1)
+
+    if [ r for r in results if "error" in r ] != []:
+        exit(1)
+
+    print(f"{GREEN}Done.{RESET}")
+
+if __name__ == "__main__":
+    main()
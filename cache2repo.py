@@ -14,16 +14,30 @@
 #    umount /mirror
 #    mdconfig -d -u 0
 #
+import concurrent.futures
 import subprocess
 import sqlite3
-import hashlib
+import tarfile
+import tempfile
+import shutil
 import getopt
 import json
+import time
 import glob
 import sys
 import re
 import os
 
+import mirrorlib
+from mirrorlib import RunMetrics, beginPhase, countMetric, traceQueries, writeMetrics, journalKey
+from mirrorlib import writeGraftList, writeRepoManifest, writeBootstrapArchive, writeISO, g_mirror
+from mirrorlib import MirrorError, RunJournal, runCommand, computeCheckSum, linkOrCopy, checkPackingFormat
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 g_licenses = {}
 g_categories = {}
 g_shlibs = {}
@@ -33,21 +47,23 @@ g_groups = {}
 g_users = {}
 g_licenselogic = {}
 g_deps = {}
+g_links = {}
 g_verboseMode = False
-g_meta = """version = 2;
-packing_format = "txz";
-manifests = "packagesite.yaml";
-filesite = "filesite.yaml";
-manifests_archive = "packagesite";
-filesite_archive = "filesite";
-"""
-g_mirror = """FreeBSD_mirror: {
-  url: "file:///mirror/",
-  mirror_type: "srv",
-  signature_type: "none",
-  enabled: yes
-}
-"""
+g_dbMmapSize = 256*1024*1024     # bytes
+g_dbCacheSize = 64*1024          # KiB
+g_zstdLevel = 9
+g_workers = os.cpu_count()
+g_checkSumCacheFile = os.path.expanduser("~/.cache/cache2repo/checksums.json")
+g_journalFile = ".cache2repo.journal"
+g_linkTables = [ "pkg_licenses",
+                 "pkg_categories",
+                 "pkg_shlibs_required",
+                 "pkg_shlibs_provided",
+                 "pkg_option",
+                 "pkg_annotation",
+                 "pkg_groups",
+                 "pkg_users"
+               ]
 
 RED    = "\033[0;31m"
 YELLOW = "\033[1;33m"
@@ -64,47 +80,44 @@ def fileExists( fName ):
     except:
         return False
 
-def getLicenses( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_licenses WHERE package_id={packageID}")
+def getLinks( table, packageID ):
+    return g_links.get(table,{}).get(packageID,[])
+
+def getLicenses( packageID ):
     retLicenses = []
-    for l in x:
+    for l in getLinks("pkg_licenses",packageID):
         retLicenses.append(g_licenses.get(l[1],"unknown"))
     return retLicenses
 
-def getCategories( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_categories WHERE package_id={packageID}")
+def getCategories( packageID ):
     retCategories = []
-    for c in x:
+    for c in getLinks("pkg_categories",packageID):
         retCategories.append(g_categories.get(c[1],"unknown"))
     return retCategories
 
-def getRequiredSHLibs( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_shlibs_required WHERE package_id={packageID}")
+def getRequiredSHLibs( packageID ):
     retShLibs= []
-    for s in x:
+    for s in getLinks("pkg_shlibs_required",packageID):
         retShLibs.append(g_shlibs.get(s[1],"unknown"))
     return retShLibs
 
-def getProvidedSHLibs( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_shlibs_provided WHERE package_id={packageID}")
+def getProvidedSHLibs( packageID ):
     retShLibs= []
-    for s in x:
+    for s in getLinks("pkg_shlibs_provided",packageID):
         retShLibs.append(g_shlibs.get(s[1],"unknown"))
     return retShLibs
 
-def getPackageOptions( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_option WHERE package_id={packageID}")
+def getPackageOptions( packageID ):
     retOptions = {}
-    for o in x:
+    for o in getLinks("pkg_option",packageID):
         optionID  = o[1]
         optionCfg = o[2]
         retOptions[ g_option[optionID] ] = optionCfg
     return retOptions
 
-def getPackageAnnotations( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_annotation WHERE package_id={packageID}")
+def getPackageAnnotations( packageID ):
     retAnnotation = {}
-    for a in x:
+    for a in getLinks("pkg_annotation",packageID):
         a1 = a[1]
         a2 = a[2]
         retAnnotation[ g_annotation[a1] ] = g_annotation[a2]
@@ -117,28 +130,194 @@ def getLicenseLogic( logic_id ):
         print(f"ERROR: unknown license logic - ID={logic_id}")
         sys.exit(0)
 
-def getPackageGroups( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_groups WHERE package_id={packageID}")
+def getPackageGroups( packageID ):
     retGroups= []
-    for g in x:
+    for g in getLinks("pkg_groups",packageID):
         retGroups.append(g_groups.get(g[1],"unknown"))
     return retGroups
 
-def getPackageUsers( cursor, packageID ):
-    x = cursor.execute(f"SELECT * FROM pkg_users WHERE package_id={packageID}")
+def getPackageUsers( packageID ):
     retUsers= []
-    for g in x:
+    for g in getLinks("pkg_users",packageID):
         retUsers.append(g_users.get(g[1],"unknown"))
     return retUsers
 
-def computeCheckSum( localFileName ):
-    checkSum = "unknown"
-    with open(localFileName, "rb") as f:
-        checkSum = hashlib.sha256()
-        for chunk in iter(lambda: f.read(4096), b""):
-            checkSum.update(chunk)
-        checkSum = checkSum.hexdigest()
-    return checkSum
+def loadCheckSumCache( cacheFile ):
+    try:
+        with open(cacheFile, "r") as f:
+            return json.load(f)
+    except:
+        return {}
+
+def saveCheckSumCache( cacheFile, cache ):
+    try:
+        cacheDir = os.path.dirname(cacheFile)
+        if cacheDir != "":
+            os.makedirs(cacheDir, exist_ok=True)
+        with open(cacheFile+".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cacheFile+".tmp", cacheFile)
+    except Exception as e:
+        if g_verboseMode: print(f"{YELLOW}WARN{RESET}: could not save checksum cache - "+str(e))
+
+def evictCheckSumCache( cache ):
+    evicted = 0
+    for fName in list(cache):
+        if not os.path.exists(fName):
+            del cache[fName]
+            evicted += 1
+    return evicted
+
+def computeCheckSums( fileNames ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # cache entries are keyed by path and only trusted while
+    # (size, mtime_ns, inode) still match what is on disk
+    cache = {}
+    if g_checkSumCacheFile is not None:
+        cache = loadCheckSumCache(g_checkSumCacheFile)
+        evicted = evictCheckSumCache(cache)
+        if g_verboseMode: print(f"{WHITE}Evicted {evicted} stale checksum cache entries{RESET}")
+    checkSums = {}
+    toHash = {}
+    for fName in fileNames:
+        try:
+            st = os.stat(fName)
+        except:
+            continue
+        key = [ st.st_size, st.st_mtime_ns, st.st_ino ]
+        entry = cache.get(fName)
+        if (entry is not None) and (entry[:3] == key):
+            checkSums[fName] = entry[3]
+        else:
+            toHash[fName] = key
+    print(f"{WHITE}Computing checksums{RESET}: {len(toHash)} to hash, {len(checkSums)} cached")
+    countMetric("checksum_cache_hits", len(checkSums))
+    countMetric("checksum_cache_misses", len(toHash))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=g_workers) as pool:
+        futures = { pool.submit(computeCheckSum, fName): fName for fName in toHash }
+        for fut in concurrent.futures.as_completed(futures):
+            fName = futures[fut]
+            try:
+                checkSums[fName] = fut.result()
+                cache[fName] = toHash[fName] + [ checkSums[fName] ]
+            except Exception as e:
+                if g_verboseMode: print(f"{RED}Exception{RESET}: "+str(e))
+    if g_checkSumCacheFile is not None:
+        saveCheckSumCache(g_checkSumCacheFile, cache)
+    return checkSums
+
+def pkgVersionKey( version ):
+    # Sort key following pkg(8) version rules closely enough to pick the
+    # newest of several cached versions: epoch (",N") first, then the
+    # dotted version with numbers compared numerically, then the port
+    # revision ("_N").
+    epoch = 0
+    revision = 0
+    if "," in version:
+        version, e = version.rsplit(",", 1)
+        epoch = int(e) if e.isdigit() else 0
+    if "_" in version:
+        version, r = version.rsplit("_", 1)
+        revision = int(r) if r.isdigit() else 0
+    parts = []
+    for token in re.findall(r"[0-9]+|[a-zA-Z]+", version):
+        if token.isdigit():
+            parts.append((1, int(token), ""))
+        else:
+            # letters sort below numbers: 1.0 < 1.0a < 1.0.1
+            parts.append((0, 0, token.lower()))
+    return (epoch, parts, revision)
+
+def selectPackages( repoPackages, cacheFolder ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # Keeps the newest version of every package (local.sqlite records come
+    # first and win ties) and maps each kept record to the artifact it
+    # refers to. name-version.pkg symlinks are resolved to their
+    # name-version~hash.pkg targets once, so every file is copied only once.
+    latest = {}
+    for p in repoPackages:
+        cur = latest.get(p["name"])
+        if (cur is None) or (pkgVersionKey(p["version"]) > pkgVersionKey(cur["version"])):
+            latest[p["name"]] = p
+    selected = [ p for p in repoPackages if latest[p["name"]] is p ]
+    artifacts = []
+    seen = set()
+    for p in selected:
+        src = os.path.realpath(cacheFolder + "/" + os.path.basename(p["path"]))
+        if src in seen: continue
+        seen.add(src)
+        artifacts.append((src, p["path"]))
+    naiveFiles = set([ os.path.realpath(f) for f in glob.glob(f"{cacheFolder}/*.pkg") ])
+    naiveBytes = sum([ os.path.getsize(f) for f in naiveFiles if os.path.exists(f) ])
+    selectedBytes = sum([ os.path.getsize(a[0]) for a in artifacts ])
+    print(f"{WHITE}Selected{RESET}: {len(artifacts)} of {len(naiveFiles)} package files, {selectedBytes/(1024*1024):.1f} MiB of {naiveBytes/(1024*1024):.1f} MiB ({(naiveBytes-selectedBytes)/(1024*1024):.1f} MiB saved)")
+    return (selected, artifacts)
+
+def copyPackages( artifacts, destDir ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # hardlinks when the cache and the output share a filesystem, falls back
+    # to an in-kernel copy otherwise; progress is printed once per second
+    for d in set([ os.path.dirname(dst) for src, dst in artifacts ]):
+        os.makedirs(destDir + "/" + d, exist_ok=True)
+    counts = { "skipped": 0, "linked": 0, "copied": 0, "failed": 0 }
+    lastReport = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=g_workers) as pool:
+        futures = { pool.submit(linkOrCopy, src, destDir + "/" + dst): src for src, dst in artifacts }
+        for n, fut in enumerate(concurrent.futures.as_completed(futures), 1):
+            try:
+                result = fut.result()
+                if g_verboseMode: print(f"{BLUE}{futures[fut]}{RESET} -> {YELLOW}{destDir}{RESET} : {result}")
+            except Exception as e:
+                result = "failed"
+                countMetric("files_failed")
+                print(f"{RED}ERROR{RESET}: could not copy {futures[fut]} - "+str(e))
+            counts[result] += 1
+            if (time.monotonic() - lastReport >= 1) or (n == len(futures)):
+                lastReport = time.monotonic()
+                print(f"  {n}/{len(futures)} files: {counts['linked']} linked, {counts['copied']} copied, {counts['skipped']} unchanged, {counts['failed']} failed", flush=True)
+    return counts
+
+def removeStalePackages( artifacts, destDir ):
+    global WHITE
+    global RESET
+    # package files left over from an earlier run whose package is no longer
+    # selected (updated or removed from the cache) would end up on the ISO
+    wanted = set([ os.path.normpath(destDir + "/" + dst) for src, dst in artifacts ])
+    removed = 0
+    for root, dirs, fileNames in os.walk(destDir + "/All"):
+        for fName in fileNames:
+            fileName = os.path.normpath(os.path.join(root, fName))
+            if fileName not in wanted:
+                os.remove(fileName)
+                removed += 1
+    countMetric("files_removed", removed)
+    if removed > 0:
+        print(f"{WHITE}Removed{RESET}: {removed} package files that are no longer selected")
+    return removed
+
+def buildBootstrap( siteDir, bootstrapFiles, mtime ):
+    # pkg-bootstrap.tgz: the host's pkg binaries and configuration
+    bootDir = siteDir + "/.bootstrap"
+    shutil.rmtree(bootDir, ignore_errors=True)
+    for src, dst in bootstrapFiles:
+        os.makedirs(os.path.dirname(bootDir+"/"+dst), exist_ok=True)
+        shutil.copy(src, bootDir+"/"+dst)
+    writeBootstrapArchive(siteDir, bootDir, mtime)
 
 def loadGlobalVars( cu ):
     global g_licenses
@@ -214,6 +393,34 @@ def computeDeps(cu):
         print(f"{RED}ERROR{RESET}:",str(e))
         sys.exit(0)
 
+def loadLinks(cu):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    try:
+        # One pass per link table instead of one query per package and table;
+        # ordering by package_id walks the (package_id, ...) index, so rows
+        # come out in the same order as the per-package lookups did
+        print(f"{WHITE}Loading package metadata...{RESET}")
+        global g_links
+        g_links = {}
+        for table in g_linkTables:
+            links = {}
+            x = cu.execute(f"SELECT * FROM {table} ORDER BY package_id")
+            for l in x:
+                package_id = l[0]
+                if package_id not in links:
+                    links[package_id] = [ l ]
+                else:
+                    links[package_id].append(l)
+            g_links[table] = links
+    except Exception as e:
+        print(f"{RED}ERROR{RESET}:",str(e))
+        sys.exit(0)
+
 def loadPackages(cu, localCache="/var/cache/pkg"):
     global g_verboseMode
     global RED
@@ -246,6 +453,7 @@ def loadPackages(cu, localCache="/var/cache/pkg"):
         
         # Build a list of packages, based on local database + local cache
         print(f"{WHITE}Building list of local packages...{RESET}")
+        checkSums = computeCheckSums([ localCache + "/" + p["name"] + "-" + p["version"] + ".pkg" for p in allPackages ])
         repoPackages = []
         for p in allPackages:
             try:
@@ -254,15 +462,15 @@ def loadPackages(cu, localCache="/var/cache/pkg"):
                 localFileName = localCache + "/" + fileName
                 #print(f"Adding {localFileName}")
                 localFileSize = os.path.getsize(localFileName)
-                localFileChecksum = computeCheckSum(localFileName)
-                pkgLicences = getLicenses(cu,p["package_id"])
+                localFileChecksum = checkSums[localFileName]
+                pkgLicences = getLicenses(p["package_id"])
                 pkgLicenseLogic = getLicenseLogic( p["licenselogic"] )
-                pkgProvidedSHLibs = getProvidedSHLibs(cu,p["package_id"])
-                pkgRequiredSHLibs = getRequiredSHLibs(cu,p["package_id"])
-                pkgOptions = getPackageOptions(cu,p["package_id"])
-                pkgGroups = getPackageGroups(cu,p["package_id"])
-                pkgUsers = getPackageUsers(cu,p["package_id"])
-                pkgLicenses = getLicenses(cu,p["package_id"])
+                pkgProvidedSHLibs = getProvidedSHLibs(p["package_id"])
+                pkgRequiredSHLibs = getRequiredSHLibs(p["package_id"])
+                pkgOptions = getPackageOptions(p["package_id"])
+                pkgGroups = getPackageGroups(p["package_id"])
+                pkgUsers = getPackageUsers(p["package_id"])
+                pkgLicenses = getLicenses(p["package_id"])
                 abi = p["arch"]
                 arch = p["arch"].lower()
                 if arch[-2:] != ":*" :
@@ -283,8 +491,8 @@ def loadPackages(cu, localCache="/var/cache/pkg"):
                              "licenselogic"      : pkgLicenseLogic,
                              "pkgsize"           : localFileSize,
                              "desc"              : p["desc"],
-                             "categories"        : getCategories(cu,p["package_id"]),
-                             "annotations"       : getPackageAnnotations(cu,p["package_id"]),
+                             "categories"        : getCategories(p["package_id"]),
+                             "annotations"       : getPackageAnnotations(p["package_id"]),
                           }
                 if [] != pkgProvidedSHLibs:
                     pkgDesc["shlibs_provided"] = pkgProvidedSHLibs
@@ -311,6 +519,90 @@ def loadPackages(cu, localCache="/var/cache/pkg"):
         sys.exit(0)
     return repoPackages
 
+def openPkgArchive( fileName ):
+    # Returns (tar stream, helper process or None) for a .pkg file. pkg(8)
+    # writes tar.zst nowadays and tar.xz/gz/bz2 in the past; tarfile handles
+    # the latter, zstd goes through the zstandard module or the zstd tool.
+    with open(fileName, "rb") as f:
+        magic = f.read(4)
+    if magic == b"\x28\xb5\x2f\xfd":
+        if zstandard is not None:
+            fIn = open(fileName, "rb")
+            reader = zstandard.ZstdDecompressor().stream_reader(fIn, closefd=True)
+            return (tarfile.open(fileobj=reader, mode="r|"), None)
+        proc = subprocess.Popen(["zstd", "-dcq", fileName], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return (tarfile.open(fileobj=proc.stdout, mode="r|"), proc)
+    return (tarfile.open(fileName, mode="r|*"), None)
+
+def readPkgManifest( fileName ):
+    # +COMPACT_MANIFEST (or +MANIFEST) are the first members of a package,
+    # so only the start of the archive is ever decompressed
+    tar, proc = openPkgArchive(fileName)
+    try:
+        for member in tar:
+            if member.name.lstrip("/") in ("+COMPACT_MANIFEST", "+MANIFEST"):
+                return json.loads(tar.extractfile(member).read())
+            if not member.name.lstrip("/").startswith("+"):
+                break
+    finally:
+        tar.close()
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+    raise ValueError(f"no manifest found in {fileName}")
+
+def manifestToRecord( manifest, fileName, fileSize, checkSum ):
+    # same layout as the records loadPackages builds from local.sqlite
+    fName = os.path.basename(fileName)
+    pkgDesc = {  "name"              : manifest["name"],
+                 "origin"            : manifest["origin"],
+                 "version"           : manifest["version"],
+                 "comment"           : manifest.get("comment"),
+                 "maintainer"        : manifest.get("maintainer"),
+                 "www"               : manifest.get("www"),
+                 "abi"               : manifest.get("abi"),
+                 "arch"              : manifest.get("arch"),
+                 "prefix"            : manifest.get("prefix"),
+                 "sum"               : checkSum,
+                 "flatsize"          : manifest.get("flatsize"),
+                 "path"              : f"All/{fName}",
+                 "repopath"          : f"All/{fName}",
+                 "licenselogic"      : manifest.get("licenselogic","single"),
+                 "pkgsize"           : fileSize,
+                 "desc"              : manifest.get("desc"),
+                 "categories"        : manifest.get("categories",[]),
+                 "annotations"       : manifest.get("annotations",{}),
+              }
+    for key in ("shlibs_provided", "shlibs_required", "options", "deps", "messages", "groups", "users", "licenses"):
+        if manifest.get(key):
+            pkgDesc[key] = manifest[key]
+    return pkgDesc
+
+def loadPackagesFromFiles( fileNames ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    print(f"{WHITE}Reading manifests from {len(fileNames)} package files...{RESET}")
+    manifests = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=g_workers) as pool:
+        futures = { pool.submit(readPkgManifest, fName): fName for fName in fileNames }
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                manifests[futures[fut]] = fut.result()
+            except Exception as e:
+                if g_verboseMode: print(f"{RED}Exception{RESET}: {futures[fut]} - "+str(e))
+    checkSums = computeCheckSums(list(manifests))
+    repoPackages = []
+    for fName in fileNames:
+        try:
+            repoPackages.append(manifestToRecord(manifests[fName], fName, os.path.getsize(fName), checkSums[fName]))
+        except Exception as e:
+            if g_verboseMode: print(f"{RED}Exception{RESET}: "+str(e))
+    return repoPackages
+
 def openLocalDB(localDBFile):
     global RED
     global YELLOW
@@ -319,8 +611,12 @@ def openLocalDB(localDBFile):
     global BLUE
     global RESET
     try:
-        cx = sqlite3.connect(localDBFile)
+        # read-only and immutable: pkg(8) is not expected to change the
+        # database underneath us, so sqlite can skip locking altogether
+        cx = traceQueries(sqlite3.connect(f"file:{localDBFile}?mode=ro&immutable=1", uri=True))
         cu = cx.cursor()
+        cu.execute(f"PRAGMA mmap_size={g_dbMmapSize}")
+        cu.execute(f"PRAGMA cache_size=-{g_dbCacheSize}")
     except:
         print(f"{RED}ERROR{RESET}: could not open local DB file {localDBFile}")
         exit(0)
@@ -339,13 +635,25 @@ def usage():
     print("  -o <dir>       : output directory")
     print("  -i <ISOfile>   : ISO file name (default=mirror.iso)")
     print("  -V <volume_ID> : volume ID for the ISO file")
+    print("  -d             : direct mode, graft packages from the cache into the ISO")
+    print("                   instead of copying them to the output directory (needs -i)")
+    print("  -z <format>    : catalogue packing format, txz or tzst (default=txz)")
+    print("  -m <source>    : package metadata source: db (local.sqlite), pkg (the .pkg")
+    print("                   files themselves) or both (default=both)")
+    print("  -j <workers>   : number of hashing workers (default=number of CPUs)")
+    print("  -C <file>      : checksum cache file, \"none\" to disable")
+    print("                   (default=~/.cache/cache2repo/checksums.json)")
+    print("  -F             : start over instead of resuming an interrupted run")
+    print("  -T <file.json> : write per-phase timings, counters and peak memory as JSON")
+    print("  -P <file.prom> : write the same metrics as a Prometheus textfile")
     print("  -n             : no color")
     print("")
     exit(0)
 
 def main():
     global g_verboseMode 
-    global g_meta
+    global g_workers
+    global g_checkSumCacheFile
     global RED
     global YELLOW
     global WHITE
@@ -362,9 +670,15 @@ def main():
     volumeID = "FreeBSD"
     setVolID = None
     keepRepoPath = False
+    directMode = False
+    packingFormat = "txz"
+    metadataSource = "both"
+    freshRun = False
+    metricsFile = None
+    prometheusFile = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "ho:vi:nV:k", ["help", "output="])
+        opts, args = getopt.getopt(sys.argv[1:], "ho:vi:nV:kj:C:dz:m:FT:P:", ["help", "output="])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -375,6 +689,14 @@ def main():
         elif o in ("-i"): isoFile = a
         elif o in ("-n"): useColor = False
         elif o in ("-k"): keepRepoPath = True
+        elif o in ("-d"): directMode = True
+        elif o in ("-z"): packingFormat = a
+        elif o in ("-m"): metadataSource = a
+        elif o in ("-F"): freshRun = True
+        elif o in ("-T"): metricsFile = a
+        elif o in ("-P"): prometheusFile = a
+        elif o in ("-j"): g_workers = int(a)
+        elif o in ("-C"): g_checkSumCacheFile = None if a == "none" else a
         elif o in ("-h", "--help"): usage()
         elif o in ("-o", "--output"): outputDir = a
         else:
@@ -387,6 +709,24 @@ def main():
         GREEN  = ""
         BLUE   = ""
         RESET  = ""
+        mirrorlib.noColor()
+
+    if metadataSource not in ("db","pkg","both"):
+        print(f"{RED}ERROR{RESET}: unknown metadata source ({metadataSource})")
+        exit(0)
+
+    try:
+        checkPackingFormat(packingFormat)
+    except MirrorError as e:
+        print(f"{RED}ERROR{RESET}: {e}")
+        exit(0)
+
+    if directMode:
+        if isoFile is None:
+            print(f"{RED}ERROR{RESET}: direct mode (-d) needs an ISO file (-i)")
+            exit(0)
+        # only the small generated files are staged, the packages are grafted
+        outputDir = tempfile.mkdtemp(prefix="cache2repo.")
 
     if os.path.exists(outputDir):
         if not os.path.isdir(outputDir):
@@ -402,60 +742,109 @@ def main():
     else:
         volumeID = volumeID + "_" + cpuType
 
-    conn, cursor = openLocalDB(localDBFile)
-    loadGlobalVars(cursor)
-    computeDeps(cursor)
-    repoPackages = loadPackages(cursor)
-
-    print(f"{WHITE}Generating packagesite.yaml...{RESET}")
-    with open(outputDir+"/"+"packagesite.yaml","w") as f:
-        for p in repoPackages:
-            f.write(json.dumps(p)+"\n")
-
-    print(f"{WHITE}Generating meta.conf...{RESET}")
-    with open(outputDir+"/"+"meta.conf","w") as f:
-        f.write(g_meta)
-
-    print(f"{WHITE}Generating packagesite.txz...{RESET}")
-    os.system(f"cd {outputDir}; bsdtar -cvof packagesite.txz packagesite.yaml > /dev/null 2> /dev/null")
-
-    print(f"{WHITE}Generating packagesite.pkg...{RESET}")
-    os.system(f"cd {outputDir}; cp packagesite.txz packagesite.pkg")
-
-    print(f"{WHITE}Copying PKG files...{RESET}")
-    os.system(f"mkdir -p {outputDir}/All; cd {outputDir}/All")
-    for f in glob.glob(f"{cacheFolder}/*.pkg"):
-        if not re.match(r".*~[0-9a-zA-Z]+.pkg$",f):
-            fName = os.path.basename(f)
-            print(f"{BLUE}{f}{RESET} -> {YELLOW}{outputDir}/All/{fName}{RESET}", flush=True )
-            os.system(f"cp {f} {outputDir}/All")
-
-    print(f"{WHITE}Preparing pkg for bootstraping...{RESET}")
-    os.system(f"mkdir -p {outputDir}/usr/sbin/; cp /usr/sbin/pkg {outputDir}/usr/sbin/pkg")
-    os.system(f"mkdir -p {outputDir}/usr/local/sbin/; cp /usr/local/sbin/pkg {outputDir}/usr/local/sbin/pkg; cp /usr/local/sbin/pkg-static {outputDir}/usr/local/sbin/pkg-static")
-    os.system(f"mkdir -p {outputDir}/usr/local/etc/; cp /usr/local/etc/pkg.conf {outputDir}/usr/local/etc/pkg.conf")
-    os.system(f"mkdir -p {outputDir}/etc/pkg/")
-
-    with open(outputDir+"/etc/pkg/"+"mirror.conf","w") as f:
-        f.write(g_mirror)
-
-    os.system(f"cd {outputDir}; tar cvzf pkg-bootstrap.tgz etc usr; rm -rf etc usr")
+    # every finished step is journaled in the output directory; an
+    # interrupted run started again with the same arguments continues where
+    # it stopped (in direct mode the staging directory, and with it the
+    # journal, is new on every run)
+    journal = RunJournal(outputDir+"/"+g_journalFile, fresh=freshRun)
 
-    if not isoFile is None:
-        print(f"{WHITE}Generating ISO file{RESET}: {isoFile}")
-        os.system(f"mkisofs -R -V {volumeID} -UDF -o {isoFile} {outputDir}")
-        if not keepRepoPath:
-            print(f"{WHITE}Deleting {outputDir}{RESET}")
-            os.system(f"rm -rf {outputDir}")
-
-    # cleanup
-    os.system(f"rm -f packagesite.yaml")
-    os.system(f"rm -f packagesite.txz")
-    os.system(f"rm -f meta.conf")
-
-    conn.close()
+    mirrorlib.g_metrics = RunMetrics("cache2repo")
+    try:
+        beginPhase("metadata")
+        pkgFiles = [ f for f in glob.glob(f"{cacheFolder}/*.pkg") if not re.match(r".*~[0-9a-zA-Z]+.pkg$",f) ]
 
+        repoPackages = []
+        if metadataSource in ("db","both"):
+            conn, cursor = openLocalDB(localDBFile)
+            loadGlobalVars(cursor)
+            computeDeps(cursor)
+            loadLinks(cursor)
+            repoPackages = loadPackages(cursor, cacheFolder)
+            conn.close()
+        if metadataSource in ("pkg","both"):
+            # whatever the database does not describe is read from the archives
+            known = set([ p["path"] for p in repoPackages ])
+            repoPackages += loadPackagesFromFiles([ f for f in pkgFiles if "All/"+os.path.basename(f) not in known ])
+
+        beginPhase("select")
+        (repoPackages, artifacts) = selectPackages(repoPackages, cacheFolder)
+        countMetric("packages_selected", len(repoPackages))
+
+        # generated files only change when their inputs do; the journal start
+        # time is their timestamp, so regenerating them gives the same bytes
+        beginPhase("manifest")
+        manifestKey = writeRepoManifest(outputDir, [ json.dumps(p).encode() for p in repoPackages ], packingFormat, journal, g_zstdLevel)
+
+        beginPhase("copy")
+        copyKey = journalKey(manifestKey, artifacts)
+        removed = 0
+        if directMode:
+            print(f"{WHITE}Generating ISO path list...{RESET}")
+            graftList = outputDir + ".graft"
+            writeGraftList(graftList, [ (dst, src) for src, dst in artifacts ])
+        else:
+            removed = removeStalePackages(artifacts, outputDir)
+            if journal.done("copy", copyKey) and all([ os.path.exists(outputDir+"/"+dst) for src, dst in artifacts ]):
+                print(f"{WHITE}PKG files are up to date{RESET}")
+            else:
+                print(f"{WHITE}Copying PKG files...{RESET}")
+                counts = copyPackages(artifacts, outputDir)
+                if counts["failed"] == 0:
+                    journal.record("copy", copyKey)
+
+        beginPhase("bootstrap")
+        bootstrapFiles = [ ("/usr/sbin/pkg",             "usr/sbin/pkg"),
+                           ("/usr/local/sbin/pkg",       "usr/local/sbin/pkg"),
+                           ("/usr/local/sbin/pkg-static","usr/local/sbin/pkg-static"),
+                           ("/usr/local/etc/pkg.conf",   "usr/local/etc/pkg.conf") ]
+        for src, dst in bootstrapFiles:
+            if not os.path.exists(src):
+                raise MirrorError(f"{src} is needed for pkg-bootstrap.tgz but does not exist")
+        bootstrapKey = journalKey([ (src, computeCheckSum(src)) for src, dst in bootstrapFiles ], g_mirror)
+        if journal.done("bootstrap", bootstrapKey) and os.path.exists(outputDir+"/pkg-bootstrap.tgz"):
+            print(f"{WHITE}pkg-bootstrap.tgz is up to date{RESET}")
+        else:
+            print(f"{WHITE}Preparing pkg for bootstraping...{RESET}")
+            buildBootstrap(outputDir, bootstrapFiles, journal.startTime)
+            journal.record("bootstrap", bootstrapKey)
+
+        if not isoFile is None:
+            beginPhase("iso")
+            isoKey = journalKey(manifestKey, copyKey, bootstrapKey, volumeID, directMode)
+            if journal.done("iso", isoKey) and os.path.exists(isoFile) and (removed == 0):
+                print(f"{WHITE}ISO file is up to date{RESET}: {isoFile}")
+            else:
+                print(f"{WHITE}Generating ISO file{RESET}: {isoFile}")
+                writeISO(isoFile, outputDir, volumeID, graftList if directMode else None, [ g_journalFile ])
+                journal.record("iso", isoKey)
+            if directMode:
+                os.remove(graftList)
+                shutil.rmtree(outputDir)
+            elif not keepRepoPath:
+                print(f"{WHITE}Deleting {outputDir}{RESET}")
+                runCommand(f"rm -rf {outputDir}")
+
+        # cleanup
+        os.system(f"rm -f packagesite.yaml")
+        os.system(f"rm -f packagesite.txz")
+        os.system(f"rm -f meta.conf")
+
+        journal.finish()
+    except MirrorError as e:
+        mirrorlib.g_metrics.fail(str(e))
+        raise
+    except Exception as e:
+        mirrorlib.g_metrics.fail(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        # failed runs are the ones worth looking at, they are written too
+        writeMetrics(metricsFile, prometheusFile)
     print(f"{GREEN}Done.{RESET}")
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except MirrorError as e:
+        # a failed shell step; the journal lets the next run resume
+        print(f"{RED}ERROR{RESET}: {e}")
+        exit(e.status)
@@ -0,0 +1,494 @@
+#!/usr/local/bin/python
+#
+# (C) 2024, Tiago Gasiba
+#           tiago.gasiba@gmail.com
+#
+# Code shared by cache2repo and repo2repo: the run journal, run metrics,
+# shell steps and the repository writer.
+#
+import collections
+import threading
+import subprocess
+import tarfile
+import gzip
+import shutil
+import lzma
+import resource
+import hashlib
+import json
+import time
+import sys
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+g_metrics = None
+g_hashBufferSize = 1024*1024     # bytes
+
+g_meta = """version = 2;
+packing_format = "{packing_format}";
+manifests = "packagesite.yaml";
+filesite = "filesite.yaml";
+manifests_archive = "packagesite";
+filesite_archive = "filesite";
+"""
+g_mirror = """FreeBSD_mirror: {
+  url: "file:///mirror/",
+  mirror_type: "srv",
+  signature_type: "none",
+  enabled: yes
+}
+"""
+
+RED    = "\033[0;31m"
+YELLOW = "\033[1;33m"
+WHITE  = "\033[1;37m"
+GREEN  = "\033[0;32m"
+BLUE   = "\033[0;34m"
+RESET  = "\033[0m"
+
+def noColor():
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    RED    = ""
+    YELLOW = ""
+    WHITE  = ""
+    GREEN  = ""
+    BLUE   = ""
+    RESET  = ""
+
+class MirrorError(Exception):
+    # A run that cannot go on. main() prints it and exits with status, the
+    # repo2repo daemon sends it back to the client.
+    def __init__( self, message, status=1 ):
+        Exception.__init__(self, message)
+        self.status = status
+
+class RunJournal:
+    # Append-only log of finished steps, one JSON record per line, flushed
+    # and fsync'ed as soon as a step completes. A step is identified by its
+    # phase and a key derived from its inputs, so a restarted run skips
+    # exactly the steps whose inputs did not change. Generated archives use
+    # the journal's start time as their timestamp, which makes a resumed run
+    # write the same bytes as an uninterrupted one.
+    # Phases listed in dropPhases are only kept while a run is unfinished.
+    def __init__( self, fileName, fresh=False, dropPhases=() ):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.records = {}
+        self.startTime = None
+        finished = False
+        if not fresh:
+            try:
+                with open(fileName, "rb") as f:
+                    goodOffset = 0
+                    for line in f:
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("unterminated record")
+                            record = json.loads(line)
+                        except ValueError:
+                            # torn last line after a crash: cut it off, or
+                            # every record appended after it is lost on load
+                            f.close()
+                            os.truncate(fileName, goodOffset)
+                            break
+                        goodOffset += len(line)
+                        if record["phase"] == "start":
+                            self.startTime = record["time"]
+                            finished = False
+                        elif record["phase"] == "finish":
+                            finished = True
+                        else:
+                            self.records[(record["phase"], record["key"])] = record
+            except OSError:
+                pass
+        if (self.startTime is None) or finished:
+            # a new run
+            self.startTime = int(time.time())
+            self.records = { k: r for (k, r) in self.records.items() if k[0] not in dropPhases }
+            with open(fileName + ".tmp", "w") as f:
+                f.write(json.dumps({ "phase": "start", "key": None, "time": self.startTime }) + "\n")
+                for record in self.records.values():
+                    f.write(json.dumps(record) + "\n")
+            os.replace(fileName + ".tmp", fileName)
+        self.f = open(fileName, "a")
+
+    def get( self, phase, key ):
+        return self.records.get((phase, key))
+
+    def done( self, phase, key ):
+        return (phase, key) in self.records
+
+    def record( self, phase, key, **data ):
+        record = dict(data, phase=phase, key=key)
+        with self.lock:
+            self.records[(phase, key)] = record
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def finish( self ):
+        self.record("finish", None)
+        self.f.close()
+
+    def close( self ):
+        # stops journaling without marking the run finished
+        self.f.close()
+
+def runCommand( cmd ):
+    # shell steps are checked; a failing one stops the run with the journal
+    # intact, so the next run picks up from the last finished step
+    rc = os.system(cmd)
+    if rc != 0:
+        raise MirrorError(f"command failed with status {rc}: {cmd}", 1)
+
+def computeCheckSum( localFileName ):
+    checkSum = "unknown"
+    with open(localFileName, "rb") as f:
+        checkSum = hashlib.sha256()
+        buf = bytearray(g_hashBufferSize)
+        view = memoryview(buf)
+        size = 0
+        while True:
+            n = f.readinto(buf)
+            if n == 0: break
+            checkSum.update(view[:n])
+            size += n
+        checkSum = checkSum.hexdigest()
+    countMetric("files_hashed")
+    countMetric("bytes_read", size)
+    return checkSum
+
+def isSameFile( src, dst ):
+    try:
+        s = os.stat(src)
+        d = os.stat(dst)
+    except:
+        return False
+    if (s.st_dev == d.st_dev) and (s.st_ino == d.st_ino):
+        return True
+    return (s.st_size == d.st_size) and (s.st_mtime_ns == d.st_mtime_ns)
+
+def copyFileData( src, dst ):
+    with open(src, "rb") as fIn, open(dst, "wb") as fOut:
+        size = os.fstat(fIn.fileno()).st_size
+        try:
+            # in-kernel copy, no data goes through user space
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(fIn.fileno(), fOut.fileno(), size - copied)
+                if n == 0: break
+                copied += n
+        except (AttributeError, OSError):
+            fIn.seek(0)
+            fOut.seek(0)
+            fOut.truncate()
+            shutil.copyfileobj(fIn, fOut, g_hashBufferSize)
+
+def linkOrCopy( src, dst, link=True ):
+    # Hardlinks src to dst, or copies it when they are on different
+    # filesystems or link is False; dst is replaced atomically. Returns
+    # "skipped", "linked" or "copied".
+    if isSameFile(src, dst):
+        countMetric("files_skipped")
+        return "skipped"
+    tmpName = dst + ".tmp"
+    if os.path.exists(tmpName):
+        os.remove(tmpName)
+    if link:
+        try:
+            os.link(os.path.realpath(src), tmpName)
+            os.replace(tmpName, dst)
+            countMetric("files_linked")
+            return "linked"
+        except OSError:
+            pass
+    copyFileData(src, tmpName)
+    st = os.stat(src)
+    os.utime(tmpName, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmpName, dst)
+    countMetric("files_copied")
+    countMetric("bytes_written", st.st_size)
+    return "copied"
+
+def journalKey( *parts ):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+def maxRSS():
+    # ru_maxrss is in KiB on FreeBSD and Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def childCPUTime():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class RunMetrics:
+    # Wall and CPU time, peak RSS and counters for every phase of a run.
+    # Phases follow each other, begin() closes the running one; counters
+    # go to the running phase and may be added from any thread. Counters
+    # named <cache>_hits / <cache>_misses are also reported as a hit ratio.
+    # A run that stops with an error is reported as failed, with the phase
+    # it stopped in.
+    def __init__( self, program ):
+        self.program = program
+        self.lock = threading.Lock()
+        self.phases = []
+        self.current = None
+        self.startTime = time.time()
+        self.error = None
+
+    def fail( self, message ):
+        self.error = message
+
+    def begin( self, name ):
+        self.end()
+        with self.lock:
+            self.current = { "phase": name, "counters": collections.Counter(), "wall": time.perf_counter(),
+                             "cpu": time.process_time(), "childCPU": childCPUTime() }
+
+    def end( self ):
+        with self.lock:
+            if self.current is None:
+                return
+            p = self.current
+            self.current = None
+            counters = dict(p["counters"])
+            ratios = {}
+            for name in counters:
+                for suffix in ("_hits", "_misses"):
+                    if name.endswith(suffix):
+                        cache = name[:-len(suffix)]
+                        hits = counters.get(cache + "_hits", 0)
+                        lookups = hits + counters.get(cache + "_misses", 0)
+                        ratios[cache] = hits / lookups if lookups else 0.0
+            self.phases.append({ "phase"             : p["phase"],
+                                 "wall_seconds"      : time.perf_counter() - p["wall"],
+                                 "cpu_seconds"       : time.process_time() - p["cpu"],
+                                 "child_cpu_seconds" : childCPUTime() - p["childCPU"],
+                                 "max_rss_bytes"     : maxRSS(),
+                                 "counters"          : counters,
+                                 "cache_hit_ratios"  : ratios })
+
+    def count( self, name, value=1 ):
+        with self.lock:
+            if self.current is not None:
+                self.current["counters"][name] += value
+
+    def report( self ):
+        self.end()
+        totals = collections.Counter()
+        for p in self.phases:
+            totals.update(p["counters"])
+        return { "program"       : self.program,
+                 "status"        : "ok" if self.error is None else "failed",
+                 "error"         : self.error,
+                 "start_time"    : self.startTime,
+                 "wall_seconds"  : sum([ p["wall_seconds"] for p in self.phases ]),
+                 "cpu_seconds"   : sum([ p["cpu_seconds"] for p in self.phases ]),
+                 "max_rss_bytes" : maxRSS(),
+                 "phases"        : self.phases,
+                 "totals"        : dict(totals) }
+
+    def writeJSON( self, fileName ):
+        with open(fileName+".tmp", "w") as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(fileName+".tmp", fileName)
+
+    def writePrometheus( self, fileName ):
+        # node_exporter textfile collector format; replaced atomically so a
+        # scrape never sees half a file
+        report = self.report()
+        prefix = self.program
+        out = []
+        def metric( name, help, samples ):
+            out.append(f"# HELP {prefix}_{name} {help}")
+            out.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                labelText = ",".join([ f'{k}="{v}"' for k, v in labels ])
+                out.append(f"{prefix}_{name}{{{labelText}}} {value}" if labelText else f"{prefix}_{name} {value}")
+        metric("last_run_timestamp_seconds", "Start time of the last run.", [ ((), report["start_time"]) ])
+        metric("last_run_success", "1 when the last run completed, 0 when it failed.", [ ((), 1 if report["status"] == "ok" else 0) ])
+        metric("max_rss_bytes", "Peak resident set size of the last run.", [ ((), report["max_rss_bytes"]) ])
+        metric("phase_wall_seconds", "Wall-clock time per phase.", [ ((("phase", p["phase"]),), f"{p['wall_seconds']:.6f}") for p in report["phases"] ])
+        metric("phase_cpu_seconds", "CPU time per phase.", [ ((("phase", p["phase"]),), f"{p['cpu_seconds']:.6f}") for p in report["phases"] ])
+        metric("phase_child_cpu_seconds", "CPU time of child processes per phase.", [ ((("phase", p["phase"]),), f"{p['child_cpu_seconds']:.6f}") for p in report["phases"] ])
+        metric("phase_max_rss_bytes", "Peak resident set size at the end of each phase.", [ ((("phase", p["phase"]),), p["max_rss_bytes"]) for p in report["phases"] ])
+        names = sorted(set([ name for p in report["phases"] for name in p["counters"] ]))
+        for name in names:
+            metric(name, f"{name.replace('_', ' ').capitalize()} per phase.", [ ((("phase", p["phase"]),), p["counters"][name]) for p in report["phases"] if name in p["counters"] ])
+        caches = sorted(set([ cache for p in report["phases"] for cache in p["cache_hit_ratios"] ]))
+        if caches != []:
+            metric("cache_hit_ratio", "Cache hit ratio per phase and cache.", [ ((("phase", p["phase"]), ("cache", cache)), f"{p['cache_hit_ratios'][cache]:.4f}")
+                                                                              for p in report["phases"] for cache in caches if cache in p["cache_hit_ratios"] ])
+        with open(fileName+".tmp", "w") as f:
+            f.write("\n".join(out) + "\n")
+        os.replace(fileName+".tmp", fileName)
+
+def beginPhase( name ):
+    if g_metrics is not None:
+        g_metrics.begin(name)
+
+def countMetric( name, value=1 ):
+    # metrics are only collected when main() set them up
+    if g_metrics is not None:
+        g_metrics.count(name, value)
+
+def traceQueries( cx ):
+    # every statement sqlite runs is counted as a query of the running phase
+    cx.set_trace_callback(lambda statement: countMetric("sql_queries"))
+    return cx
+
+def writeMetrics( metricsFile, prometheusFile ):
+    if metricsFile is not None:
+        g_metrics.writeJSON(metricsFile)
+    if prometheusFile is not None:
+        g_metrics.writePrometheus(prometheusFile)
+
+def checkPackingFormat( packingFormat ):
+    # txz always works, through xz or Python's lzma; tzst needs the
+    # zstandard module or the zstd tool
+    if packingFormat not in ("txz","tzst"):
+        raise MirrorError(f"unsupported packing format ({packingFormat})")
+    if (packingFormat == "tzst") and (zstandard is None) and (shutil.which("zstd") is None):
+        raise MirrorError("tzst packing needs the zstandard Python module or the zstd tool, install one of them or use txz")
+
+class CatalogueCompressor:
+    # Write-only stream that compresses into fileName. Python's lzma has no
+    # multithreaded encoder, so xz -T0 is fed through a pipe when it is
+    # installed; zstd runs in-process when the zstandard module is present.
+    def __init__( self, fileName, packingFormat, zstdLevel=9 ):
+        self.fOut = open(fileName, "wb")
+        self.proc = None
+        if packingFormat == "txz":
+            if shutil.which("xz") is not None:
+                self.proc = subprocess.Popen(["xz", "-T0", "-6", "--block-size=8MiB", "-c"], stdin=subprocess.PIPE, stdout=self.fOut)
+                self.stream = self.proc.stdin
+            else:
+                self.stream = lzma.LZMAFile(self.fOut, "wb", preset=6)
+        elif packingFormat == "tzst":
+            if zstandard is not None:
+                cctx = zstandard.ZstdCompressor(level=zstdLevel, threads=-1)
+                self.stream = cctx.stream_writer(self.fOut, closefd=False)
+            else:
+                self.proc = subprocess.Popen(["zstd", "-T0", "-q", f"-{zstdLevel}", "-c"], stdin=subprocess.PIPE, stdout=self.fOut)
+                self.stream = self.proc.stdin
+        else:
+            self.fOut.close()
+            raise ValueError(f"unsupported packing format: {packingFormat}")
+
+    def write( self, data ):
+        self.stream.write(data)
+
+    def close( self ):
+        self.stream.close()
+        if self.proc is not None:
+            if self.proc.wait() != 0:
+                raise OSError(f"compressor exited with status {self.proc.returncode}")
+        self.fOut.close()
+
+def writeCatalogueArchive( archiveName, lines, packingFormat, memberName="packagesite.yaml", mtime=None, zstdLevel=9 ):
+    # Single-member tar written by hand so the manifest lines can be streamed
+    # straight into the compressor: header, data, padding, end-of-archive.
+    size = 0
+    for line in lines:
+        size += len(line) + 1
+    info = tarfile.TarInfo(memberName)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time()) if mtime is None else mtime
+    header = info.tobuf(format=tarfile.USTAR_FORMAT)
+    out = CatalogueCompressor(archiveName, packingFormat, zstdLevel)
+    out.write(header)
+    for line in lines:
+        out.write(line)
+        out.write(b"\n")
+    total = len(header) + size + (-size % tarfile.BLOCKSIZE) + 2*tarfile.BLOCKSIZE
+    out.write(b"\0" * ((-size % tarfile.BLOCKSIZE) + 2*tarfile.BLOCKSIZE + (-total % tarfile.RECORDSIZE)))
+    out.close()
+
+def writeCatalogue( siteDir, lines, packingFormat, mtime=None, zstdLevel=9 ):
+    # packagesite.<format> plus the packagesite.pkg copy newer pkg(8) asks for
+    archiveName = siteDir + "/packagesite." + packingFormat
+    writeCatalogueArchive(archiveName, lines, packingFormat, mtime=mtime, zstdLevel=zstdLevel)
+    shutil.copyfile(archiveName, siteDir + "/packagesite.pkg")
+    countMetric("files_written", 2)
+    countMetric("bytes_written", 2*os.path.getsize(archiveName))
+
+def writeGraftList( listFile, grafts ):
+    # mkisofs -graft-points path list: one "iso/path=local/path" per line,
+    # with "\\" and "=" escaped in both halves
+    with open(listFile, "w") as f:
+        for isoPath, localPath in grafts:
+            isoPath = isoPath.replace("\\","\\\\").replace("=","\\=")
+            localPath = localPath.replace("\\","\\\\").replace("=","\\=")
+            f.write(f"{isoPath}={localPath}\n")
+
+def writeISO( isoFile, sourceDir, volumeID, graftList=None, exclude=() ):
+    # mkisofs of sourceDir, plus the files of a -graft-points path list when
+    # there is one; exclude holds -m patterns. Written under a temporary
+    # name, a crash never leaves a truncated ISO behind.
+    options = f"-R -V {volumeID} -UDF"
+    if graftList is not None:
+        options += f" -graft-points -path-list {graftList}"
+    for pattern in exclude:
+        options += f" -m '{pattern}'"
+    runCommand(f"mkisofs {options} -o {isoFile}.part {sourceDir}")
+    os.replace(isoFile+".part", isoFile)
+    countMetric("files_written")
+    countMetric("bytes_written", os.path.getsize(isoFile))
+
+def writeRepoManifest( siteDir, lines, packingFormat, journal, zstdLevel=9 ):
+    global WHITE
+    global RESET
+    # meta.conf and packagesite.<format> for the manifest lines, skipped when
+    # the journal has the same lines written already. The journal start time
+    # is the archive timestamp, so writing them again gives the same bytes.
+    # Returns the manifest key later steps derive their keys from.
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line)
+    manifestKey = journalKey(digest.hexdigest(), packingFormat, g_meta)
+    manifestFiles = [ siteDir+"/meta.conf", siteDir+"/packagesite."+packingFormat, siteDir+"/packagesite.pkg" ]
+    if journal.done("manifest", manifestKey) and all([ os.path.exists(f) for f in manifestFiles ]):
+        print(f"{WHITE}meta.conf and packagesite.{packingFormat} are up to date{RESET}")
+    else:
+        print(f"{WHITE}Generating meta.conf...{RESET}")
+        with open(siteDir+"/"+"meta.conf","w") as f:
+            f.write(g_meta.format(packing_format=packingFormat))
+
+        print(f"{WHITE}Generating packagesite.{packingFormat}...{RESET}")
+        writeCatalogue(siteDir, lines, packingFormat, journal.startTime, zstdLevel)
+        journal.record("manifest", manifestKey)
+    return manifestKey
+
+def writeBootstrapArchive( siteDir, bootDir, mtime ):
+    # pkg-bootstrap.tgz from the usr/ tree staged in bootDir plus the mirror
+    # configuration, packed with fixed owners and timestamps so rebuilding
+    # it gives the same archive. bootDir is removed afterwards.
+    os.makedirs(bootDir+"/etc/pkg", exist_ok=True)
+    with open(bootDir+"/etc/pkg/mirror.conf","w") as f:
+        f.write(g_mirror)
+    def normalize( info ):
+        info.mtime = mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        return info
+    archiveName = siteDir + "/pkg-bootstrap.tgz"
+    with open(archiveName + ".tmp", "wb") as f:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=mtime) as gz:
+            with tarfile.open(fileobj=gz, mode="w", format=tarfile.USTAR_FORMAT) as tar:
+                for top in ("etc", "usr"):
+                    tar.add(bootDir+"/"+top, arcname=top, filter=normalize)
+    os.replace(archiveName + ".tmp", archiveName)
+    shutil.rmtree(bootDir)
+    countMetric("files_written")
+    countMetric("bytes_written", os.path.getsize(archiveName))
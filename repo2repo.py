@@ -14,33 +14,60 @@
 #    umount /mirror
 #    mdconfig -d -u 0
 #
+import concurrent.futures
+import collections
+import socketserver
+import contextlib
+import socket
+import threading
 import requests
+import hashlib
+import tempfile
 import tarfile
+import zlib
+import sqlite3
+import shutil
 import getopt
+import signal
+import random
+import queue
+import time
 import json
+import io
 import glob
+import fnmatch
 import sys
 import re
 import os
-import io
+
+import mirrorlib
+from mirrorlib import RunMetrics, beginPhase, countMetric, traceQueries, writeMetrics, journalKey
+from mirrorlib import writeCatalogue, writeGraftList, writeRepoManifest, writeBootstrapArchive, writeISO, g_meta, g_mirror
+from mirrorlib import MirrorError, RunJournal, runCommand, computeCheckSum, linkOrCopy, checkPackingFormat
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 g_headers = { "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:99.0) Gecko/20100101 Firefox/99.0"
           }
 
-g_meta = """version = 2;
-packing_format = "txz";
-manifests = "packagesite.yaml";
-filesite = "filesite.yaml";
-manifests_archive = "packagesite";
-filesite_archive = "filesite";
-"""
-g_mirror = """FreeBSD_mirror: {
-  url: "file:///mirror/",
-  mirror_type: "srv",
-  signature_type: "none",
-  enabled: yes
-}
-"""
+g_workers = 8
+g_timeout = 60
+g_retries = 4
+g_backoffBase = 1.0             # seconds
+g_backoffMax = 60.0
+g_chunkSize = 1024*1024
+g_zstdLevel = 9
+g_stateFile = ".repo2repo.state"
+g_journalFile = ".repo2repo.journal"
+g_volumeWindow = 8              # open volumes a package may still go to
+g_catalogueCacheDir = os.path.expanduser("~/.cache/repo2repo")
+g_catalogueIndexSchema = "3"
+g_threadLocal = threading.local()
+g_printLock = threading.Lock()
+
 g_pkg_conf ="""# System-wide configuration file for pkg(8)
 # For more information on the file format and
 # options please refer to the pkg.conf(5) man page
@@ -144,55 +171,1087 @@ def getFileSize( fileName ):
     except:
         return -1
 
-def fetchURL( url ):
+def computeCheckSums( fileNames, workers=g_workers ):
+    # hashlib releases the GIL while hashing, so threads are enough
+    checkSums = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = { pool.submit(computeCheckSum, fName): fName for fName in fileNames }
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                checkSums[futures[fut]] = fut.result()
+            except Exception as e:
+                checkSums[futures[fut]] = None
+    return checkSums
+
+def getFileState( fileName ):
+    try:
+        st = os.stat(fileName)
+        return [ st.st_size, st.st_mtime_ns ]
+    except:
+        return None
+
+def loadRepoState( localRepoPath ):
+    # {"catalogue": {name: [repopath, sum]}, "files": {repopath: [size, mtime_ns, sha256]}}
+    try:
+        with open(localRepoPath+"/"+g_stateFile, "r") as f:
+            state = json.load(f)
+        return { "catalogue": state.get("catalogue",{}), "files": state.get("files",{}) }
+    except:
+        return { "catalogue": {}, "files": {} }
+
+def saveRepoState( localRepoPath, state ):
+    fName = localRepoPath+"/"+g_stateFile
+    with open(fName+".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(fName+".tmp", fName)
+
+def newSession():
     global g_headers
+    # one keep-alive connection pool per host, sized for the worker count
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=g_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(g_headers)
+    return session
+
+def getSession():
+    # requests.Session is not thread safe, so every worker keeps its own
+    session = getattr(g_threadLocal, "session", None)
+    if session is None:
+        session = newSession()
+        g_threadLocal.session = session
+    return session
+
+def downloadFile( url, fileName, expectedSize=None, progress=None ):
+    # Streams url into fileName.part and renames it into place once complete.
+    # A .part file left over by an interrupted run is resumed with a Range
+    # request; servers that ignore Range simply send the whole file again.
+    partName = fileName + ".part"
+    offset = getFileSize(partName)
+    if offset < 0:
+        offset = 0
+    if (expectedSize is not None) and (offset > expectedSize):
+        offset = 0
+    headers = {}
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
     try:
-        response = requests.get(url, headers=g_headers)
-        if response.status_code == 200:
-            return response.content
-        else:
+        with getSession().get(url, headers=headers, stream=True, timeout=g_timeout) as response:
+            if (response.status_code == 416) and (offset == expectedSize):
+                os.replace(partName, fileName)
+                return 0
+            if response.status_code == 200:
+                offset = 0
+            elif response.status_code != 206:
+                return None
+            received = 0
+            with open(partName, "ab" if offset > 0 else "wb") as f:
+                for chunk in response.iter_content(chunk_size=g_chunkSize):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress.add(len(chunk))
+        if (expectedSize is not None) and (getFileSize(partName) != expectedSize):
             return None
+        os.replace(partName, fileName)
+        return received
     except Exception as e:
         return None
 
-def extractFromTXZ( inData, wantedFile ):
+class MirrorSet:
+    # Health and throughput bookkeeping for the configured mirrors. Each
+    # download goes to the mirror with the best smoothed throughput per
+    # connection in flight; mirrors that have not been measured yet are
+    # tried first, and a failing mirror is benched with exponential backoff.
+    def __init__( self, urls ):
+        self.lock = threading.Lock()
+        self.mirrors = []
+        for url in urls:
+            self.mirrors.append({ "url": url.rstrip("/"), "rate": None, "inflight": 0, "failures": 0,
+                                  "retryAt": 0.0, "bytes": 0, "ok": 0, "failed": 0 })
+
+    def pick( self, exclude=() ):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [ m for m in self.mirrors if (m["retryAt"] <= now) and (m["url"] not in exclude) ]
+            if candidates == []:
+                candidates = [ m for m in self.mirrors if m["url"] not in exclude ] or self.mirrors
+            untried = [ m for m in candidates if m["rate"] is None ]
+            if untried != []:
+                best = min(untried, key=lambda m: m["inflight"])
+            else:
+                best = max(candidates, key=lambda m: m["rate"] / (1 + m["inflight"]))
+            best["inflight"] += 1
+            return best["url"]
+
+    def find( self, url ):
+        for m in self.mirrors:
+            if m["url"] == url:
+                return m
+
+    def success( self, url, nBytes, seconds ):
+        with self.lock:
+            m = self.find(url)
+            m["inflight"] -= 1
+            rate = nBytes / max(seconds, 0.001)
+            m["rate"] = rate if m["rate"] is None else 0.7*m["rate"] + 0.3*rate
+            m["failures"] = 0
+            m["bytes"] += nBytes
+            m["ok"] += 1
+
+    def failure( self, url ):
+        with self.lock:
+            m = self.find(url)
+            m["inflight"] -= 1
+            m["failures"] += 1
+            m["failed"] += 1
+            m["retryAt"] = time.monotonic() + backoffDelay(m["failures"])
+
+    def report( self ):
+        global WHITE
+        global RESET
+        for m in self.mirrors:
+            rate = "-" if m["rate"] is None else f"{m['rate']/(1024*1024):.2f} MiB/s"
+            print(f"  {WHITE}{m['url']}{RESET}: {m['ok']} ok, {m['failed']} failed, {m['bytes']/(1024*1024):.1f} MiB, {rate}")
+
+def backoffDelay( attempt ):
+    # exponential backoff with jitter, capped at g_backoffMax
+    return min(g_backoffMax, g_backoffBase * (2 ** (attempt - 1))) * random.uniform(0.5, 1.0)
+
+class DownloadProgress:
+    # Byte-weighted progress for a batch of downloads. On a terminal a status
+    # line with throughput and ETA is redrawn twice a second and per-file
+    # messages are printed above it; in quiet mode nothing is printed at all.
+    def __init__( self, totalBytes, quiet=False ):
+        self.lock = threading.Lock()
+        self.totalBytes = totalBytes
+        self.doneBytes = 0
+        self.startTime = time.monotonic()
+        self.quiet = quiet
+        self.live = (not quiet) and sys.stdout.isatty()
+        self.stopEvent = threading.Event()
+        self.thread = None
+        if self.live:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def add( self, nBytes ):
+        with self.lock:
+            self.doneBytes += nBytes
+
+    def render( self ):
+        global WHITE
+        global RESET
+        elapsed = max(time.monotonic() - self.startTime, 0.001)
+        done = min(self.doneBytes, self.totalBytes)
+        fraction = done / self.totalBytes if self.totalBytes > 0 else 1.0
+        rate = self.doneBytes / elapsed
+        eta = (self.totalBytes - done) / rate if rate > 0 else 0
+        bar = "#" * int(30 * fraction) + "." * (30 - int(30 * fraction))
+        return f"[{bar}] {100*fraction:5.1f}% {done/(1024*1024):.1f}/{self.totalBytes/(1024*1024):.1f} MiB {rate/(1024*1024):.2f} MiB/s ETA {int(eta)//60}:{int(eta)%60:02d}"
+
+    def draw( self ):
+        with g_printLock:
+            sys.stdout.write("\r\033[K" + self.render())
+            sys.stdout.flush()
+
+    def run( self ):
+        while not self.stopEvent.wait(0.5):
+            self.draw()
+
+    def message( self, text ):
+        if self.quiet:
+            return
+        with g_printLock:
+            if self.live:
+                sys.stdout.write("\r\033[K")
+            print(text, flush=True)
+            if self.live:
+                sys.stdout.write(self.render())
+                sys.stdout.flush()
+
+    def stop( self ):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            with g_printLock:
+                sys.stdout.write("\r\033[K")
+                sys.stdout.flush()
+
+def downloadWorker( jobs, results, progress, config ):
     global RED
     global YELLOW
     global WHITE
     global GREEN
     global BLUE
     global RESET
+    while True:
+        job = jobs.get()
+        if job is None:
+            jobs.task_done()
+            break
+        pName, repoPath, fileName, pkgSize, pkgSum = job
+        # a job that blows up counts as a failed package; the worker has to
+        # stay alive or the producer blocks on the bounded queue
+        try:
+            tried = []
+            for attempt in range(1, config.retries + 2):
+                mirror = config.mirrors.pick(tried)
+                fileURL = mirror + "/" + repoPath
+                startTime = time.monotonic()
+                received = None
+                try:
+                    received = downloadFile(fileURL, fileName, pkgSize, progress)
+                    if received is not None:
+                        status = f"{GREEN}OK{RESET}"
+                        if (pkgSum is not None) and (computeCheckSum(fileName) != pkgSum):
+                            countMetric("checksum_mismatches")
+                            os.remove(fileName)
+                            received = None
+                            status = f"{RED}CHECKSUM MISMATCH{RESET}"
+                    else:
+                        status = f"{RED}FAILED{RESET}"
+                except:
+                    received = None
+                    raise
+                finally:
+                    # the mirror's in-flight slot is given back whatever
+                    # happened, or its routing weight stays skewed
+                    if received is not None:
+                        config.mirrors.success(mirror, received, time.monotonic() - startTime)
+                    else:
+                        config.mirrors.failure(mirror)
+                if received is not None:
+                    countMetric("files_downloaded")
+                    countMetric("bytes_downloaded", received)
+                    if config.journal is not None:
+                        config.journal.record("package", fileName, state=getFileState(fileName), sum=pkgSum)
+                    break
+                countMetric("download_failures")
+                if mirror not in tried:
+                    tried.append(mirror)
+                if len(tried) == len(config.mirrors.mirrors):
+                    tried = []
+                if attempt <= config.retries:
+                    progress.message(f"{BLUE}{fileURL}{RESET} -> {YELLOW}{fileName}{RESET} : {status}, retrying")
+                    time.sleep(backoffDelay(attempt))
+            results.append((pName, received))
+            progress.message(f"{BLUE}{fileURL}{RESET} -> {YELLOW}{fileName}{RESET} : {status}")
+        except Exception as e:
+            countMetric("download_failures")
+            results.append((pName, None))
+            progress.message(f"{YELLOW}{fileName}{RESET} : {RED}FAILED{RESET} ({e})")
+        finally:
+            jobs.task_done()
+
+def downloadPackages( toFetch, config ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # toFetch is a list of (package name, repo path, local file name, size,
+    # sum). Jobs are handed out largest first (LPT), so the big packages do
+    # not end up alone on the last connections; the queue is bounded so only
+    # a couple of jobs per worker are ever in flight.
+    if toFetch == []:
+        return {}
+    toFetch = sorted(toFetch, key=lambda job: job[3], reverse=True)
+    remainingBytes = 0
+    for job in toFetch:
+        remainingBytes += job[3] - max(getFileSize(job[2] + ".part"), 0)
+    progress = DownloadProgress(remainingBytes, config.quiet)
+    jobs = queue.Queue(maxsize=2*config.workers)
+    results = []
+    workers = []
+    for n in range(config.workers):
+        t = threading.Thread(target=downloadWorker, args=(jobs, results, progress, config), daemon=True)
+        t.start()
+        workers.append(t)
+    startTime = time.monotonic()
+    for job in toFetch:
+        jobs.put(job)
+    for t in workers:
+        jobs.put(None)
+    for t in workers:
+        t.join()
+    progress.stop()
+    elapsed = time.monotonic() - startTime
+    totalBytes = sum([ r[1] for r in results if r[1] is not None ])
+    failed = [ r[0] for r in results if r[1] is None ]
+    rate = totalBytes / elapsed / (1024*1024) if elapsed > 0 else 0
+    print(f"{WHITE}Downloaded{RESET}: {len(results)-len(failed)} packages, {totalBytes/(1024*1024):.1f} MiB in {elapsed:.1f}s ({rate:.2f} MiB/s, {config.workers} workers)")
+    config.mirrors.report()
+    if failed != []:
+        print(f"{RED}ERROR{RESET}: {len(failed)} packages could not be downloaded")
+    return dict(results)
+
+def storeObjectPath( storeDir, pkgSum ):
+    # content-addressed: objects/<first two hex digits>/<sha256>.pkg
+    return storeDir + "/objects/" + pkgSum[:2] + "/" + pkgSum + ".pkg"
+
+def storeRefFile( storeDir, localRepoPath ):
+    key = hashlib.sha256(os.path.abspath(localRepoPath).encode()).hexdigest()[:16]
+    return storeDir + "/refs/" + key + ".json"
+
+def saveStoreRefs( storeDir, localRepoPath, sums ):
+    # every mirror records the objects it uses; these are the reference
+    # counts the garbage collector works from
+    refFile = storeRefFile(storeDir, localRepoPath)
+    os.makedirs(os.path.dirname(refFile), exist_ok=True)
+    with open(refFile+".tmp", "w") as f:
+        json.dump({ "path": os.path.abspath(localRepoPath), "sums": sorted(set(sums)) }, f)
+    os.replace(refFile+".tmp", refFile)
+
+def collectStoreGarbage( storeDir ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # mirrors whose directory is gone no longer hold references
+    refCount = {}
+    for refFile in glob.glob(storeDir + "/refs/*.json"):
+        try:
+            with open(refFile, "r") as f:
+                refs = json.load(f)
+        except:
+            continue
+        if not os.path.isdir(refs["path"]):
+            os.remove(refFile)
+            continue
+        for s in refs["sums"]:
+            refCount[s] = refCount.get(s, 0) + 1
+    freedFiles = 0
+    freedBytes = 0
+    for objectFile in glob.glob(storeDir + "/objects/*/*.pkg"):
+        if refCount.get(os.path.basename(objectFile)[:-4], 0) == 0:
+            freedBytes += getFileSize(objectFile)
+            freedFiles += 1
+            os.remove(objectFile)
+    countMetric("files_removed", freedFiles)
+    countMetric("bytes_freed", freedBytes)
+    print(f"{WHITE}Store garbage collection{RESET}: {freedFiles} objects removed, {freedBytes/(1024*1024):.1f} MiB freed")
+
+class DirectorySource:
+    # A directory tree that may already hold byte-identical packages: the
+    # local pkg cache, a mounted mirror ISO, another mirror. Any object with
+    # a files() method can be used as a local source.
+    def __init__( self, path ):
+        self.path = path
+
+    def files( self ):
+        for root, dirs, fileNames in os.walk(self.path):
+            for fName in fileNames:
+                if fName.endswith(".pkg"):
+                    yield os.path.join(root, fName)
+
+class MirrorConfig:
+    # How packages are fetched and where they are kept, as the command line
+    # options set it: the mirrors of repoURLs, download workers and retries,
+    # the shared store, local sources and the catalogue cache. A Catalogue
+    # owns one and every build from it uses it; it also holds the journal of
+    # the build in progress and the local source hashes between builds.
+    def __init__( self, repoURLs, workers=g_workers, retries=g_retries, storeDir=None, localSources=(),
+                  catalogueCacheDir=g_catalogueCacheDir, quiet=False ):
+        self.mirrors = MirrorSet(repoURLs)
+        self.workers = workers
+        self.retries = retries
+        self.storeDir = storeDir
+        self.localSources = list(localSources)
+        self.catalogueCacheDir = catalogueCacheDir
+        self.quiet = quiet
+        self.journal = None
+        self.sourceHashCache = None
+
+    def openJournal( self, localRepoPath, fresh=False ):
+        # every finished step is journaled in the repo path; an interrupted run
+        # started again with the same arguments continues where it stopped
+        fileName = localRepoPath+"/"+g_journalFile
+        if (self.journal is not None) and (self.journal.fileName != fileName):
+            self.journal.close()
+            self.journal = None
+        if self.journal is None:
+            # per-package records are already in the state file once a run finished
+            self.journal = RunJournal(fileName, fresh=fresh, dropPhases=("package",))
+        return self.journal
+
+def loadSourceHashCache( config ):
+    if config.sourceHashCache is not None:
+        return config.sourceHashCache
+    if config.catalogueCacheDir is None:
+        return {}
     try:
-        with tarfile.open(fileobj=io.BytesIO(inData), mode='r:xz') as tar:
-            file_data = tar.extractfile(wantedFile)
-            if file_data:
-                return file_data.read()
+        with open(config.catalogueCacheDir + "/localsources.json", "r") as f:
+            return json.load(f)
+    except:
+        return {}
+
+def saveSourceHashCache( config, cache ):
+    config.sourceHashCache = cache
+    if config.catalogueCacheDir is None:
+        return
+    os.makedirs(config.catalogueCacheDir, exist_ok=True)
+    cacheFile = config.catalogueCacheDir + "/localsources.json"
+    with open(cacheFile+".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(cacheFile+".tmp", cacheFile)
+
+def buildLocalIndex( config, wantedSizes ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # sha256 -> local file. Only files whose size matches a package we still
+    # need are hashed, and hashes are remembered by (size, mtime_ns, inode).
+    cache = loadSourceHashCache(config)
+    index = {}
+    toHash = {}
+    seen = set()
+    for source in config.localSources:
+        for fName in source.files():
+            realName = os.path.realpath(fName)
+            if realName in seen: continue
+            seen.add(realName)
+            try:
+                st = os.stat(realName)
+            except:
+                continue
+            if st.st_size not in wantedSizes: continue
+            key = [ st.st_size, st.st_mtime_ns, st.st_ino ]
+            entry = cache.get(realName)
+            if (entry is not None) and (entry[:3] == key):
+                index[entry[3]] = realName
+                countMetric("source_hash_cache_hits")
+            else:
+                toHash[realName] = key
+                countMetric("source_hash_cache_misses")
+    for fName, checkSum in computeCheckSums(list(toHash), config.workers).items():
+        if checkSum is not None:
+            cache[fName] = toHash[fName] + [ checkSum ]
+            index[checkSum] = fName
+    for fName in list(cache):
+        if not os.path.exists(fName):
+            del cache[fName]
+    saveSourceHashCache(config, cache)
+    print(f"{WHITE}Local sources{RESET}: {len(seen)} files scanned, {len(toHash)} hashed, {len(index)} candidates")
+    return index
+
+def syncPackages( allPkg, pkgNames, localRepoPath, config, forceVerify=False ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # A package is current when the catalogue still lists the same repopath
+    # and sum as in the previous run and the file on disk still has the
+    # size/mtime recorded after it was verified. Anything else is re-hashed
+    # (in parallel) and only fetched again when the hash does not match.
+    journal = config.journal
+    storeDir = config.storeDir
+    state = loadRepoState(localRepoPath)
+    prevCatalogue = state["catalogue"]
+    files = state["files"]
+    localPaths = []
+    unchanged = []
+    toVerify = {}
+    toFetch = []
+    for p in pkgNames:
+        repoPath = allPkg[p].repopath
+        pkgSum = allPkg[p].sum
+        fileName = localRepoPath + "/" + repoPath
+        localPath = os.path.dirname(os.path.realpath(fileName))
+        if localPath not in localPaths:
+            localPaths.append(localPath)
+            os.makedirs(localPath, exist_ok=True)
+        fileState = getFileState(fileName)
+        known = files.get(repoPath)
+        journaled = journal.get("package", fileName) if journal is not None else None
+        if (not forceVerify) and (fileState is not None) and (known is not None) and \
+           (known[:2] == fileState) and (known[2] == pkgSum):
+            unchanged.append(p)
+        elif (fileState is not None) and (journaled is not None) and \
+             (journaled["state"] == fileState) and (journaled["sum"] == pkgSum):
+            # fetched and verified by an interrupted run
+            files[repoPath] = fileState + [ pkgSum ]
+            unchanged.append(p)
+        elif (fileState is not None) and (fileState[0] == allPkg[p].pkgsize):
+            toVerify[fileName] = (p, repoPath, fileName, allPkg[p].pkgsize, pkgSum)
+        else:
+            toFetch.append((p, repoPath, fileName, allPkg[p].pkgsize, pkgSum))
+    if toVerify != {}:
+        print(f"{WHITE}Verifying {len(toVerify)} local packages...{RESET}")
+    for fileName, checkSum in computeCheckSums(list(toVerify), config.workers).items():
+        job = toVerify[fileName]
+        if (checkSum is not None) and (checkSum == job[4]):
+            files[allPkg[job[0]].repopath] = getFileState(fileName) + [ checkSum ]
+            unchanged.append(job[0])
+            if journal is not None:
+                journal.record("package", fileName, state=getFileState(fileName), sum=checkSum)
+        else:
+            toFetch.append(job)
+
+    added   = [ p for p in pkgNames if p not in prevCatalogue ]
+    changed = [ p for p in pkgNames if (p in prevCatalogue) and (prevCatalogue[p] != [ allPkg[p].repopath, allPkg[p].sum ]) ]
+    removed = [ p for p in prevCatalogue if p not in pkgNames ]
+    print(f"{WHITE}Catalogue changes{RESET}: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+
+    # with a shared store, packages already in it are linked in and new ones
+    # are downloaded into it once, whichever mirror asks for them
+    fromStore = []
+    inStore = 0
+    downloads = toFetch
+    if storeDir is not None:
+        downloads = []
+        remaining = []
+        for job in toFetch:
+            (p, repoPath, fileName, pkgSize, pkgSum) = job
+            if pkgSum is None:
+                downloads.append(job)
+            elif os.path.exists(storeObjectPath(storeDir, pkgSum)):
+                fromStore.append(job)
             else:
-                print(f"{RED}File '{wantedFile}' not found in the archive.{RESET}")
+                remaining.append(job)
+        objects = {}
+        for (p, repoPath, fileName, pkgSize, pkgSum) in remaining:
+            if pkgSum not in objects:
+                objects[pkgSum] = (p, repoPath, storeObjectPath(storeDir, pkgSum), pkgSize, pkgSum)
+                os.makedirs(os.path.dirname(storeObjectPath(storeDir, pkgSum)), exist_ok=True)
+        downloads += list(objects.values())
+        inStore = len(fromStore)
+        fromStore += remaining
+
+    # before going to the network, look for identical files on local disks
+    seeded = []
+    if (config.localSources != []) and (downloads != []):
+        localIndex = buildLocalIndex(config, set([ job[3] for job in downloads ]))
+        remaining = []
+        for job in downloads:
+            (p, repoPath, fileName, pkgSize, pkgSum) = job
+            if pkgSum in localIndex:
+                # copied, never linked: the source file belongs to the user
+                # and must not share an inode with the repo or the store
+                linkOrCopy(localIndex[pkgSum], fileName, link=False)
+                seeded.append(job)
+            else:
+                remaining.append(job)
+        downloads = remaining
+    print(f"{WHITE}Local packages{RESET}: {len(unchanged)} up to date, {inStore} from store, {len(seeded)} from local sources, {len(downloads)} to fetch")
+    countMetric("packages_up_to_date", len(unchanged))
+    countMetric("packages_from_store", inStore)
+    countMetric("packages_from_local_sources", len(seeded))
+    countMetric("packages_to_fetch", len(downloads))
+
+    fetched = downloadPackages(downloads, config)
+    for (p, repoPath, fileName, pkgSize, pkgSum) in seeded:
+        fetched[p] = 0
+    for (p, repoPath, fileName, pkgSize, pkgSum) in downloads + seeded:
+        if (fetched.get(p) is not None) and (storeDir is None or pkgSum is None):
+            files[allPkg[p].repopath] = getFileState(fileName) + [ pkgSum ]
+    for (p, repoPath, fileName, pkgSize, pkgSum) in fromStore:
+        if os.path.exists(storeObjectPath(storeDir, pkgSum)):
+            linkOrCopy(storeObjectPath(storeDir, pkgSum), fileName)
+            files[allPkg[p].repopath] = getFileState(fileName) + [ pkgSum ]
+
+    # drop files that are no longer part of the selection
+    wanted = set([ allPkg[p].repopath for p in pkgNames ])
+    for repoPath in list(files):
+        if repoPath not in wanted:
+            try:
+                os.remove(localRepoPath + "/" + repoPath)
+                countMetric("files_removed")
+            except:
+                pass
+            del files[repoPath]
+
+    synced = [ p for p in pkgNames if allPkg[p].repopath in files ]
+    state["catalogue"] = { p: [ allPkg[p].repopath, allPkg[p].sum ] for p in synced }
+    state["files"] = files
+    saveRepoState(localRepoPath, state)
+    if storeDir is not None:
+        saveStoreRefs(storeDir, localRepoPath, [ allPkg[p].sum for p in synced if allPkg[p].sum is not None ])
+    return synced
+
+class PkgRecord:
+    # Only the fields needed to resolve and fetch a package are kept as
+    # attributes; the full manifest stays available as the original line.
+    __slots__ = ( "name", "origin", "categories", "flavor", "deps", "shlibs_required", "shlibs_provided",
+                  "repopath", "pkgsize", "sum", "line" )
+
+    def __init__( self, line ):
+        package = json.loads(line)
+        self.name = package["name"]
+        self.origin = package.get("origin", "")
+        self.categories = tuple(package.get("categories",[]))
+        self.flavor = package.get("annotations",{}).get("flavor", "")
+        self.deps = tuple(package.get("deps",{}))
+        self.shlibs_required = tuple(package.get("shlibs_required",[]))
+        self.shlibs_provided = tuple(package.get("shlibs_provided",[]))
+        self.repopath = package["repopath"]
+        self.pkgsize = package["pkgsize"]
+        self.sum = package.get("sum")
+        self.line = line
+
+    @classmethod
+    def fromIndex( cls, row ):
+        package = cls.__new__(cls)
+        name, origin, categories, flavor, deps, shlibsRequired, shlibsProvided, repopath, pkgsize, sum, line = row
+        package.name = name
+        package.origin = origin
+        package.categories = tuple(categories.split())
+        package.flavor = flavor
+        package.deps = tuple(deps.split())
+        package.shlibs_required = tuple(shlibsRequired.split())
+        package.shlibs_provided = tuple(shlibsProvided.split())
+        package.repopath = repopath
+        package.pkgsize = pkgsize
+        package.sum = sum
+        package.line = line
+        return package
+
+    def indexRow( self ):
+        return ( self.name, self.origin, " ".join(self.categories), self.flavor, " ".join(self.deps),
+                 " ".join(self.shlibs_required), " ".join(self.shlibs_provided), self.repopath, self.pkgsize, self.sum, self.line )
+
+    def manifest( self ):
+        return json.loads(self.line)
+
+def iterCatalogueLines( fileObj, wantedFile="packagesite.yaml" ):
+    # stream mode: the archive is decompressed as it is read from fileObj
+    with tarfile.open(fileobj=fileObj, mode="r|xz") as tar:
+        for member in tar:
+            if member.name == wantedFile:
+                for line in tar.extractfile(member):
+                    line = line.rstrip(b"\n")
+                    if line != b"":
+                        yield line
+                return
+    raise tarfile.TarError(f"file '{wantedFile}' not found in the archive")
+
+def loadPackageListFromURL( url ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    pkgList = {}
+    try:
+        with getSession().get(url, stream=True, timeout=g_timeout) as response:
+            if response.status_code != 200:
                 return None
+            response.raw.decode_content = True
+            for line in iterCatalogueLines(response.raw):
+                package = PkgRecord(line)
+                pkgList[package.name] = package
+            countMetric("bytes_downloaded", response.raw.tell())
     except tarfile.TarError as e:
-        print("Error extracting file:", e)
+        print(f"{RED}Error extracting catalogue{RESET}:", e)
         return None
+    except Exception as e:
+        return None
+    return pkgList
 
-def loadPackageListFromURL( url ):
+def openCatalogueIndex( cacheDir, url ):
+    # one SQLite index per catalogue URL under the catalogue cache directory
+    os.makedirs(cacheDir, exist_ok=True)
+    key = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return cacheDir + "/" + key + ".sqlite"
+
+def readCatalogueIndexMeta( indexFile ):
+    try:
+        cx = traceQueries(sqlite3.connect(f"file:{indexFile}?mode=ro", uri=True))
+        meta = dict(cx.execute("SELECT key, value FROM meta").fetchall())
+        cx.close()
+        return meta
+    except:
+        return {}
+
+def loadCatalogueIndex( indexFile ):
     pkgList = {}
-    pSite = fetchURL(url)
-    if pSite != None:
-        pSiteYAML = extractFromTXZ(pSite, "packagesite.yaml")
-        if pSiteYAML:
-            for p in pSiteYAML.decode().split("\n"):
-                try:
-                    if p == "": continue
-                    package = json.loads(p)
-                    pName = package["name"]
-                    pkgList[pName] = package
-                except:
+    cx = traceQueries(sqlite3.connect(f"file:{indexFile}?mode=ro", uri=True))
+    for row in cx.execute("SELECT name, origin, categories, flavor, deps, shlibs_required, shlibs_provided, repopath, pkgsize, sum, line FROM packages"):
+        package = PkgRecord.fromIndex(row)
+        pkgList[package.name] = package
+    cx.close()
+    return pkgList
+
+def catalogueTempFile( indexFile, suffix ):
+    # unique names in the cache directory, so a daemon and a command line
+    # run sharing the cache never write to each other's files
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(indexFile), prefix=os.path.basename(indexFile)+".", suffix=suffix)
+    os.close(fd)
+    return tmpName
+
+def saveCatalogueIndex( indexFile, pkgList, meta ):
+    tmpName = catalogueTempFile(indexFile, ".tmp")
+    try:
+        cx = traceQueries(sqlite3.connect(tmpName))
+        cx.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        cx.execute("CREATE TABLE packages (name TEXT PRIMARY KEY, origin TEXT, categories TEXT, flavor TEXT, deps TEXT, shlibs_required TEXT, "
+                   "shlibs_provided TEXT, repopath TEXT, pkgsize INTEGER, sum TEXT, line BLOB)")
+        cx.executemany("INSERT INTO meta VALUES (?,?)", [ (k, v) for k, v in meta.items() if v is not None ])
+        cx.executemany("INSERT INTO packages VALUES (?,?,?,?,?,?,?,?,?,?,?)", [ p.indexRow() for p in pkgList.values() ])
+        cx.commit()
+        cx.close()
+        os.replace(tmpName, indexFile)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+def updateCatalogueIndexMeta( indexFile, meta ):
+    # same catalogue under new validators: only the meta rows change
+    cx = traceQueries(sqlite3.connect(indexFile))
+    cx.execute("DELETE FROM meta")
+    cx.executemany("INSERT INTO meta VALUES (?,?)", [ (k, v) for k, v in meta.items() if v is not None ])
+    cx.commit()
+    cx.close()
+
+def loadCatalogue( url, previous=None, cacheDir=g_catalogueCacheDir ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # Conditional GET against the cached ETag/Last-Modified: an unchanged
+    # catalogue costs a single 304 round trip and is loaded from the local
+    # index without any JSON parsing. A 200 whose digest matches the cached
+    # one is also served from the index. A caller holding the catalogue it
+    # loaded before passes it as previous: it is returned as it is when
+    # nothing changed, and its records are reused for unchanged lines. The
+    # index lives in cacheDir; without one the catalogue is parsed each time.
+    if cacheDir is None:
+        return loadPackageListFromURL(url)
+    indexFile = openCatalogueIndex(cacheDir, url)
+    meta = readCatalogueIndexMeta(indexFile)
+    if meta.get("schema") != g_catalogueIndexSchema:
+        meta = {}                   # older layout, rebuilt from the catalogue
+    headers = {}
+    if "etag" in meta:
+        headers["If-None-Match"] = meta["etag"]
+    if "last_modified" in meta:
+        headers["If-Modified-Since"] = meta["last_modified"]
+    tmpName = catalogueTempFile(indexFile, ".txz")
+    try:
+        with getSession().get(url, headers=headers, stream=True, timeout=g_timeout) as response:
+            if (response.status_code == 304) and (meta != {}):
+                print(f"{WHITE}Catalogue not modified, using local index{RESET}")
+                countMetric("catalogue_cache_hits")
+                return previous if previous is not None else loadCatalogueIndex(indexFile)
+            if response.status_code != 200:
+                return None
+            digest = hashlib.sha256()
+            with open(tmpName, "wb") as f:
+                for chunk in response.iter_content(chunk_size=g_chunkSize):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    countMetric("bytes_downloaded", len(chunk))
+            newMeta = { "schema"        : g_catalogueIndexSchema,
+                        "url"           : url,
+                        "etag"          : response.headers.get("ETag"),
+                        "last_modified" : response.headers.get("Last-Modified"),
+                        "digest"        : digest.hexdigest()
+                      }
+        if meta.get("digest") == newMeta["digest"]:
+            print(f"{WHITE}Catalogue unchanged, using local index{RESET}")
+            countMetric("catalogue_cache_hits")
+            if { k: v for k, v in newMeta.items() if v is not None } != meta:
+                updateCatalogueIndexMeta(indexFile, newMeta)
+            return previous if previous is not None else loadCatalogueIndex(indexFile)
+        else:
+            countMetric("catalogue_cache_misses")
+            known = {}
+            if previous is not None:
+                known = { p.line: p for p in previous.values() }
+            pkgList = {}
+            with open(tmpName, "rb") as f:
+                for line in iterCatalogueLines(f):
+                    package = known.get(line)
+                    if package is None:
+                        package = PkgRecord(line)
+                    pkgList[package.name] = package
+        saveCatalogueIndex(indexFile, pkgList, newMeta)
+        return pkgList
+    except tarfile.TarError as e:
+        print(f"{RED}Error extracting catalogue{RESET}:", e)
+        return None
+    except Exception as e:
+        return None
+    finally:
+        os.remove(tmpName)
+
+def planPackages( allPkg, pkgNames, localRepoPath, config ):
+    # Read-only version of the classification syncPackages does: name ->
+    # "current", "verify" (on disk with the right size, hash unknown),
+    # "store", "local" (identical file in a local source) or "fetch".
+    # Nothing is downloaded, created or hashed in the repo path.
+    state = loadRepoState(localRepoPath)
+    files = state["files"]
+    status = {}
+    candidates = []
+    for p in pkgNames:
+        repoPath = allPkg[p].repopath
+        pkgSum = allPkg[p].sum
+        fileState = getFileState(localRepoPath + "/" + repoPath)
+        known = files.get(repoPath)
+        if (fileState is not None) and (known is not None) and (known[:2] == fileState) and (known[2] == pkgSum):
+            status[p] = "current"
+        elif (fileState is not None) and (fileState[0] == allPkg[p].pkgsize):
+            status[p] = "verify"
+        elif (config.storeDir is not None) and (pkgSum is not None) and os.path.exists(storeObjectPath(config.storeDir, pkgSum)):
+            status[p] = "store"
+        else:
+            status[p] = "fetch"
+            candidates.append(p)
+    if (config.localSources != []) and (candidates != []):
+        localIndex = buildLocalIndex(config, set([ allPkg[p].pkgsize for p in candidates ]))
+        for p in candidates:
+            if allPkg[p].sum in localIndex:
+                status[p] = "local"
+    return status
+
+def estimateISOSize( allPkg, pkgNames ):
+    # ISO9660 stores every file in whole 2 KiB sectors; a sector per file
+    # and a fixed 1 MiB cover directory records, Rock Ridge/UDF structures
+    # and the volume descriptors. The catalogue is sized with a fast zlib
+    # pass, an upper bound for both xz and zstd.
+    sector = 2048
+    def sectors( size ):
+        return -(-size // sector) * sector
+    total = 1024*1024
+    compressor = zlib.compressobj(1)
+    catalogueSize = 0
+    for p in pkgNames:
+        total += sectors(allPkg[p].pkgsize) + sector
+        catalogueSize += len(compressor.compress(allPkg[p].line + b"\n"))
+    catalogueSize += len(compressor.flush())
+    total += 2*sectors(catalogueSize)                   # packagesite.<format>, packagesite.pkg
+    total += sectors(len(g_meta)) + sector
+    if "pkg" in allPkg:
+        total += sectors(allPkg["pkg"].pkgsize)         # pkg-bootstrap.tgz
+    return total
+
+def parseSize( text ):
+    # "4480M", "4.3G", "700000000"; K/M/G/T are powers of 1024
+    units = { "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4 }
+    text = text.strip().upper().rstrip("B").rstrip("I")
+    if (text != "") and (text[-1] in units):
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def volumeCost( pkg ):
+    # room a package takes on a volume: its sectors, a directory record and
+    # its share of the two catalogue copies (compressed lines, generously)
+    sector = 2048
+    return -(-pkg.pkgsize // sector) * sector + sector + len(pkg.line) // 2
+
+def splitVolumes( allPkg, pkgNames, roots, capacity, shlibIndex=None ):
+    # Bin packing that keeps every volume closed under dependencies, so each
+    # one works on its own: a root is added together with whatever part of
+    # its closure the volume does not hold yet, and shared dependencies are
+    # repeated on every volume that needs them. Closures are computed once
+    # up front; trying a root on a volume only takes the set difference with
+    # what the volume holds. Roots go first-fit over the last few volumes
+    # opened, largest closure first.
+    # Returns (volumes, split) where split lists the roots whose closure is
+    # larger than a volume; those are spread over volumes in dependency
+    # order. With a shlibIndex, the providers of required shared libraries
+    # count as dependencies too.
+    # the catalogue copies, meta.conf, pkg-bootstrap.tgz and the ISO
+    # structures are reserved up front, packages get the rest
+    reserved = estimateISOSize(allPkg, [])
+    capacity -= reserved
+    members = set(pkgNames)
+    depIndex = {}
+    cost = {}
+    for p in pkgNames:
+        depIndex[p] = [ d for d in allPkg[p].deps if d in members ]
+        if shlibIndex is not None:
+            depIndex[p] += shlibIndex.edges(p, members)
+        cost[p] = volumeCost(allPkg[p])
+
+    def walk( root, present, budget ):
+        # packages of root's closure missing from present, dependencies
+        # first, or None when they need more than budget
+        if root in present:
+            return ([], 0)
+        seen = set([ root ])
+        order = []
+        total = 0
+        stack = [ (root, iter(depIndex[root])) ]
+        while stack:
+            p, deps = stack[-1]
+            for d in deps:
+                if (d not in seen) and (d not in present):
+                    seen.add(d)
+                    stack.append((d, iter(depIndex[d])))
+                    break
+            else:
+                stack.pop()
+                order.append(p)
+                total += cost[p]
+                if total > budget:
                     return None
+        return (order, total)
+
+    # every volume carries pkg's closure, and every package has to fit on a
+    # volume next to it; anything else cannot be laid out at all
+    if capacity <= 0:
+        raise MirrorError(f"volume size too small, the catalogue and ISO structures alone need {reserved/(1024*1024):.1f} MiB")
+    base = walk("pkg", set(), float("inf"))[0] if "pkg" in members else []
+    baseCost = sum([ cost[p] for p in base ])
+    if baseCost > capacity:
+        raise MirrorError(f"pkg and its dependencies need {baseCost/(1024*1024):.2f} MiB, a volume only has room for {capacity/(1024*1024):.2f} MiB")
+    tooLarge = sorted([ p for p in pkgNames if (p not in base) and (cost[p] > capacity - baseCost) ], key=lambda p: cost[p], reverse=True)
+    if tooLarge != []:
+        raise MirrorError(f"{len(tooLarge)} packages do not fit on a volume, the largest is {tooLarge[0]} with {cost[tooLarge[0]]/(1024*1024):.2f} MiB "
+                          f"of {(capacity - baseCost)/(1024*1024):.2f} MiB available; use a larger volume size")
+    # every closure, computed once: in dependency order each package's
+    # closure is the union of its dependencies' ones; a package on a
+    # dependency cycle is walked instead
+    closures = {}
+    for start in pkgNames:
+        if start in closures: continue
+        stack = [ (start, iter(depIndex[start])) ]
+        onStack = set([ start ])
+        while stack:
+            p, deps = stack[-1]
+            for d in deps:
+                if (d not in closures) and (d not in onStack):
+                    onStack.add(d)
+                    stack.append((d, iter(depIndex[d])))
+                    break
+            else:
+                stack.pop()
+                onStack.discard(p)
+                if all([ d in closures for d in depIndex[p] ]):
+                    closures[p] = frozenset([ p ]).union(*[ closures[d] for d in depIndex[p] ])
+                else:
+                    closures[p] = frozenset(walk(p, set(), float("inf"))[0])
+    def missingFrom( root, volume ):
+        # what the volume lacks of root's closure, or None when it needs
+        # more than the volume's free space
+        order = closures[root].difference(volume["present"])
+        total = sum(map(cost.__getitem__, order))
+        if total > volume["free"]:
+            return None
+        return (list(order), total)
+    baseSet = set(base)
+    closureCost = {}
+    for r in roots:
+        if r not in members: continue
+        closureCost[r] = sum([ cost[p] for p in closures[r] if p not in baseSet ])
+
+    volumes = []
+    split = []
+    placed = set()
+    def newVolume():
+        volume = { "names": list(base), "present": set(base), "free": capacity - baseCost }
+        volumes.append(volume)
+        placed.update(base)
+        return volume
+    def add( volume, order, total ):
+        volume["names"] += order
+        volume["present"].update(order)
+        volume["free"] -= total
+        placed.update(order)
+
+    # packages only reachable through a root missing from the mirror are
+    # placed as roots of their own at the end
+    roots = [ r for r in roots if r in members ]
+    for r in sorted(roots, key=lambda r: closureCost[r], reverse=True) + pkgNames:
+        if r in placed:
+            continue
+        for volume in volumes[-g_volumeWindow:]:
+            if cost[r] > volume["free"]:
+                continue
+            missing = missingFrom(r, volume)
+            if missing is not None:
+                add(volume, *missing)
+                break
         else:
+            volume = newVolume()
+            missing = missingFrom(r, volume)
+            if missing is not None:
+                add(volume, *missing)
+                continue
+            # too large for any volume: fill volumes in dependency order
+            split.append(r)
+            for p in walk(r, volume["present"], float("inf"))[0]:
+                if (cost[p] > volume["free"]) and (len(volume["names"]) > len(base)):
+                    volume = newVolume()
+                if p not in volume["present"]:
+                    add(volume, [ p ], cost[p])
+    return ([ volume["names"] for volume in volumes ], split)
+
+def writeVolumes( allPkg, volumes, localRepoPath, siteDir, isoFile, volumeID, packingFormat, baseKey, journal ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # Each volume gets a packagesite of its own packages; meta.conf and
+    # pkg-bootstrap.tgz come from siteDir and packages are grafted from the
+    # repo path. name.iso becomes name-1.iso, name-2.iso, ...
+    (isoBase, isoExt) = os.path.splitext(isoFile)
+    for n, names in enumerate(volumes, 1):
+        volumeFile = f"{isoBase}-{n}{isoExt}"
+        volumeKey = journalKey(baseKey, [ allPkg[p].sum for p in names ], volumeID, n)
+        size = sum([ allPkg[p].pkgsize for p in names ])
+        if journal.done("volume", volumeKey) and os.path.exists(volumeFile):
+            print(f"{WHITE}ISO file is up to date{RESET}: {volumeFile}")
+            continue
+        print(f"{WHITE}Generating ISO file{RESET}: {volumeFile} ({len(names)} packages, {size/(1024*1024):.1f} MiB)")
+        volumeDir = tempfile.mkdtemp(prefix="repo2repo.")
+        writeCatalogue(volumeDir, [ allPkg[p].line for p in names ], packingFormat, journal.startTime, g_zstdLevel)
+        graftList = volumeDir + ".graft"
+        writeGraftList(graftList, [ (allPkg[p].repopath, os.path.realpath(localRepoPath+"/"+allPkg[p].repopath)) for p in names ] +
+                                  [ ("meta.conf", os.path.realpath(siteDir+"/meta.conf")), ("pkg-bootstrap.tgz", os.path.realpath(siteDir+"/pkg-bootstrap.tgz")) ])
+        writeISO(volumeFile, volumeDir, f"{volumeID}_{n}", graftList)
+        os.remove(graftList)
+        shutil.rmtree(volumeDir)
+        journal.record("volume", volumeKey)
+
+def loadPlan( fileName ):
+    try:
+        with open(fileName, "r") as f:
+            plan = json.load(f)
+        if plan.get("version") != 1:
             return None
-    else:
+        return plan
+    except:
         return None
-    return pkgList
+
+def savePlan( fileName, plan ):
+    with open(fileName+".tmp", "w") as f:
+        json.dump(plan, f, indent=1)
+    os.replace(fileName+".tmp", fileName)
+
+def buildBootstrap( siteDir, pkgFile, mtime ):
+    # pkg-bootstrap.tgz: pkg/pkg-static from the pkg package plus the pkg
+    # configuration
+    tmpDir = siteDir + "/.tmp"
+    bootDir = siteDir + "/.bootstrap"
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    shutil.rmtree(bootDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+    runCommand(f"cd {tmpDir}; tar xzf {pkgFile} 2> /dev/null")
+    os.makedirs(bootDir+"/usr/local/sbin")
+    shutil.copy(tmpDir+"/usr/local/sbin/pkg", bootDir+"/usr/local/sbin/pkg")
+    shutil.copy(tmpDir+"/usr/local/sbin/pkg-static", bootDir+"/usr/local/sbin/pkg-static")
+    os.makedirs(bootDir+"/usr/local/etc")
+    with open(bootDir+"/usr/local/etc/pkg.conf","w") as f:
+        f.write(g_pkg_conf)
+    writeBootstrapArchive(siteDir, bootDir, mtime)
+    shutil.rmtree(tmpDir)
 
 def loadWantedPkg( fileName ):
     allWantedPkg = {}
@@ -200,6 +1259,7 @@ def loadWantedPkg( fileName ):
         with open(fileName, "r") as f:
             lines = f.read().split("\n")
             for line in lines:
+                line = line.strip()
                 if line != "":
                     if line[0]!="#":
                         allWantedPkg[line] = line
@@ -207,38 +1267,576 @@ def loadWantedPkg( fileName ):
     except Exception as e:
         return None
 
-def getNewDeps( currList, allPkg, skipUnknown ):
+class SelectionRules:
+    # The lines of a selection list, compiled once and evaluated in a single
+    # pass over the catalogue. A line holds one or more terms, all of which
+    # must match:
+    #   vim                 exact package name
+    #   py311-*             glob on the name (*, ?, [...])
+    #   ~py3[0-9]+-.*       regular expression on the whole name
+    #   origin:www/nginx    origin:, category:, flavor: and name: pick the
+    #   category:databases  field, with exact, glob or ~regex values
+    #   !term ...           exclusion: whatever the line matches is left out
+    # Exclusions win over inclusions and only apply to the selection; a
+    # dependency of a selected package is still part of the closure.
+    # Exact values are dictionary lookups. Globs are indexed by their literal
+    # prefix (or suffix), so a package is only tested against the globs that
+    # share one with it; only globs starting and ending with a wildcard and
+    # regular expressions are tried on every package.
+    fields = ( "name", "origin", "category", "flavor" )
+
+    def __init__( self, lines ):
+        # raises ValueError on an unknown field or a bad regular expression
+        self.lines = list(lines)
+        self.terms = []                     # number of terms of each rule
+        self.exclude = []
+        self.exact = { f: collections.defaultdict(list) for f in self.fields }
+        self.prefix = { f: collections.defaultdict(list) for f in self.fields }
+        self.suffix = { f: collections.defaultdict(list) for f in self.fields }
+        self.other = { f: [] for f in self.fields }
+        for rule, line in enumerate(self.lines):
+            exclude = line.startswith("!")
+            terms = line[1:].split() if exclude else line.split()
+            if terms == []:
+                raise ValueError(f"empty exclusion: {line}")
+            self.terms.append(len(terms))
+            self.exclude.append(exclude)
+            for term, text in enumerate(terms):
+                field, sep, value = text.partition(":")
+                if sep == "":
+                    field, value = "name", text
+                if field not in self.fields:
+                    raise ValueError(f"unknown field '{field}' in: {line}")
+                ref = (rule, term)
+                if value.startswith("~"):
+                    try:
+                        self.other[field].append((ref, re.compile(value[1:]).fullmatch))
+                    except re.error as e:
+                        raise ValueError(f"{e} in: {line}")
+                    continue
+                wild = [ i for i, c in enumerate(value) if c in "*?[" ]
+                if wild == []:
+                    self.exact[field][value].append(ref)
+                    continue
+                test = re.compile(fnmatch.translate(value)).match
+                last = max(wild[-1], value.rfind("]"))
+                if wild[0] > 0:
+                    self.prefix[field][value[:wild[0]]].append((ref, test))
+                elif last < len(value) - 1:
+                    self.suffix[field][value[last+1:]].append((ref, test))
+                else:
+                    self.other[field].append((ref, test))
+        self.prefixLengths = { f: sorted(set([ len(k) for k in self.prefix[f] ])) for f in self.fields }
+        self.suffixLengths = { f: sorted(set([ len(k) for k in self.suffix[f] ])) for f in self.fields }
+
+    def matchValue( self, field, value, matched ):
+        # adds every (rule, term) matching value to matched
+        matched.update(self.exact[field].get(value, ()))
+        for n in self.prefixLengths[field]:
+            for ref, test in self.prefix[field].get(value[:n], ()):
+                if test(value): matched.add(ref)
+        for n in self.suffixLengths[field]:
+            for ref, test in self.suffix[field].get(value[-n:], ()):
+                if test(value): matched.add(ref)
+        for ref, test in self.other[field]:
+            if test(value): matched.add(ref)
+
+    def select( self, allPkg ):
+        # Returns (names, unmatched): the selected package names, ordered by
+        # the first line selecting them, and the lines that matched nothing.
+        # A plain package name missing from the catalogue is selected anyway
+        # so that it shows up as an unknown package.
+        selected = []
+        used = set()
+        for name, pkg in allPkg.items():
+            matched = set()
+            self.matchValue("name", name, matched)
+            if pkg.origin != "":
+                self.matchValue("origin", pkg.origin, matched)
+            if pkg.flavor != "":
+                self.matchValue("flavor", pkg.flavor, matched)
+            for category in pkg.categories:
+                self.matchValue("category", category, matched)
+            if not matched:
+                continue
+            terms = collections.Counter([ rule for rule, term in matched ])
+            rules = [ rule for rule in terms if terms[rule] == self.terms[rule] ]
+            used.update(rules)
+            first = min([ rule for rule in rules if not self.exclude[rule] ], default=None)
+            if (first is not None) and not any([ self.exclude[rule] for rule in rules ]):
+                selected.append((first, name))
+        unmatched = []
+        for rule, line in enumerate(self.lines):
+            if rule in used:
+                continue
+            if (not self.exclude[rule]) and (line in self.exact["name"]) and (self.terms[rule] == 1):
+                selected.append((rule, line))
+            else:
+                unmatched.append(line)
+        selected.sort()
+        return ([ name for rule, name in selected ], unmatched)
+
+def buildDepIndex( allPkg ):
+    # adjacency list (name -> dependency names), built once per catalogue
+    depIndex = {}
+    for name, pkg in allPkg.items():
+        depIndex[name] = pkg.deps
+    return depIndex
+
+class ShlibIndex:
+    # Shared libraries of a catalogue, built once: which packages provide
+    # each library (in name order, so the choice of provider is stable) and
+    # which libraries each package requires. pkg(8) leaves libraries of the
+    # base system out of shlibs_required, so every required library should
+    # be provided by some package.
+    def __init__( self, allPkg ):
+        self.providers = collections.defaultdict(list)
+        self.required = {}
+        for name in sorted(allPkg):
+            pkg = allPkg[name]
+            for lib in pkg.shlibs_provided:
+                self.providers[lib].append(name)
+            if pkg.shlibs_required != ():
+                self.required[name] = pkg.shlibs_required
+
+    def provider( self, lib, members ):
+        # a provider already in members, the first one in the catalogue
+        # otherwise, None when no package provides lib
+        providers = self.providers.get(lib)
+        if not providers:
+            return None
+        for p in providers:
+            if p in members:
+                return p
+        return providers[0]
+
+    def edges( self, name, members ):
+        # providers within members of the libraries name requires
+        edges = []
+        for lib in self.required.get(name, ()):
+            p = self.provider(lib, members)
+            if (p is not None) and (p in members) and (p != name):
+                edges.append(p)
+        return edges
+
+    def unsatisfied( self, names ):
+        # {package: [(library, provider or None)]} for every required library
+        # that no package in names provides; provider is the package of the
+        # catalogue that would satisfy it
+        members = set(names)
+        missing = {}
+        for name in names:
+            for lib in self.required.get(name, ()):
+                p = self.provider(lib, members)
+                if (p is None) or (p not in members):
+                    missing.setdefault(name, []).append((lib, p))
+        return missing
+
+def resolveClosure( wanted, depIndex, shlibIndex=None ):
+    # Worklist walk over depIndex. Returns (closure, unknown): closure maps
+    # every package in the closure to the package that pulled it in (None
+    # for packages that were asked for), unknown does the same for names
+    # that are not in the catalogue. With a shlibIndex, the closure also
+    # takes in a provider of every required shared library; those are only
+    # chosen once the dependencies are exhausted, so a provider the
+    # dependencies bring in anyway is preferred over another one.
+    closure = {}
+    unknown = {}
+    work = collections.deque()
+    shlibWork = collections.deque()
+    for p in wanted:
+        if p in closure or p in unknown: continue
+        if p in depIndex:
+            closure[p] = None
+            work.append(p)
+        else:
+            unknown[p] = None
+    while work or shlibWork:
+        if not work:
+            p = shlibWork.popleft()
+            for lib in shlibIndex.required.get(p, ()):
+                d = shlibIndex.provider(lib, closure)
+                if (d is None) or (d in closure): continue
+                closure[d] = p
+                work.append(d)
+            continue
+        p = work.popleft()
+        if shlibIndex is not None:
+            shlibWork.append(p)
+        for d in depIndex[p]:
+            if d in closure or d in unknown: continue
+            if d in depIndex:
+                closure[d] = p
+                work.append(d)
+            else:
+                unknown[d] = p
+    return (closure, unknown)
+
+def reportShlibs( missing, closure, where="" ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    for name in missing:
+        chain = ' <- '.join(whyPackage(name, closure)[1:])
+        chain = f" (pulled in by {chain})" if chain != "" else ""
+        for lib, provider in missing[name]:
+            hint = f"provided by {provider}, which is not in the mirror" if provider is not None else "no package provides it"
+            print(f"{YELLOW}WARN{RESET}: {WHITE}{name}{RESET}{chain} requires {WHITE}{lib}{RESET}{where}: {hint}")
+
+def whyPackage( p, closure ):
+    # chain of packages from p back to the selected package that needs it
+    chain = [ p ]
+    while closure.get(chain[-1]) is not None:
+        chain.append(closure[chain[-1]])
+    return chain
+
+class Catalogue:
+    # The catalogue of the first mirror in repoURLs that serves it, with the
+    # indexes the resolver works on. A long-running caller keeps it and
+    # calls refresh() again: that costs one conditional request when the
+    # mirror has nothing new, and only the lines that changed are parsed
+    # when it has. options go to the MirrorConfig every build from this
+    # catalogue uses.
+    def __init__( self, repoURLs, **options ):
+        self.repoURLs = repoURLs
+        self.config = MirrorConfig(repoURLs, **options)
+        self.url = None
+        self.allPkg = None
+        self.key = None
+        self.depIndex = None
+        self.shlibIndex = None
+        self.refreshTime = None
+
+    def refresh( self ):
+        global RED
+        global YELLOW
+        global WHITE
+        global GREEN
+        global BLUE
+        global RESET
+        # returns True when the catalogue changed, raises MirrorError (and
+        # keeps what it had) when no mirror serves it
+        allPkg = None
+        for repoURL in self.repoURLs:
+            url = repoURL.rstrip("/")+"/packagesite.txz"
+            print(f"{WHITE}Getting list of packages from{RESET}: {url}")
+            allPkg = loadCatalogue(url, self.allPkg if url == self.url else None, self.config.catalogueCacheDir)
+            if allPkg is not None:
+                break
+            print(f"{YELLOW}WARN{RESET}: unable to load the list of packages from {url}")
+        if allPkg is None:
+            raise MirrorError("no mirror could provide the list of packages")
+        self.refreshTime = time.time()
+        if allPkg is self.allPkg:
+            return False
+        digest = hashlib.sha256()
+        for p in sorted(allPkg):
+            digest.update(allPkg[p].line)
+        changed = digest.hexdigest() != self.key
+        self.url = url
+        self.allPkg = allPkg
+        self.key = digest.hexdigest()
+        self.depIndex = buildDepIndex(allPkg)
+        self.shlibIndex = ShlibIndex(allPkg)
+        return changed
+
+def selectWanted( catalogue, rules, source="selection" ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # package names selected by the lines of a selection list
+    try:
+        selection = SelectionRules(rules)
+    except ValueError as e:
+        raise MirrorError(f"{source}: {e}")
+    (wanted, unmatched) = selection.select(catalogue.allPkg)
+    for line in unmatched:
+        print(f"{YELLOW}WARN{RESET}: {WHITE}{line}{RESET} matches no package")
+    return wanted
+
+def resolvePackages( catalogue, wanted, skipUnknown=False, closeShlibs=False, strictShlibs=False, planned=None ):
+    global RED
+    global YELLOW
+    global WHITE
+    global GREEN
+    global BLUE
+    global RESET
+    # Closure of wanted plus pkg, taken from the journal or from planned
+    # (closure, unknown) when there is one. Returns (closure, unknown,
+    # unsatisfied) as resolveClosure() and ShlibIndex.unsatisfied() do;
+    # unknown packages raise MirrorError unless skipUnknown is set,
+    # unsatisfied libraries only with strictShlibs and are reported otherwise.
+    beginPhase("closure")
+    print(f"{WHITE}Generating list of packages to fetch...{RESET}")
+    journal = catalogue.config.journal
+    closureKey = journalKey(catalogue.key, list(wanted), skipUnknown, closeShlibs)
+    journaled = journal.get("closure", closureKey) if journal is not None else None
+    if journaled is not None:
+        closure = journaled["closure"]
+        unknown = journaled["unknown"]
+    elif planned is not None:
+        (closure, unknown) = planned
+    else:
+        (closure, unknown) = resolveClosure(list(wanted) + [ "pkg" ], catalogue.depIndex, catalogue.shlibIndex if closeShlibs else None)
+    for u in unknown:
+        if unknown[u] is None:
+            print(f"{YELLOW}WARN{RESET}: unknown package {WHITE}{u}{RESET}")
+        else:
+            print(f"{YELLOW}WARN{RESET}: unknown package {WHITE}{u}{RESET} (required by {' <- '.join(whyPackage(unknown[u], closure))})")
+    if (unknown != {}) and (not skipUnknown):
+        raise MirrorError(f"{len(unknown)} unknown packages, use -s to skip them")
+    # a library missing from an offline mirror only shows when a program
+    # fails to start on the target, so it is checked before anything else
+    unsatisfied = catalogue.shlibIndex.unsatisfied(list(closure))
+    reportShlibs(unsatisfied, closure)
+    if unsatisfied != {}:
+        hint = ", use -D to add their providers" if not closeShlibs else ""
+        if strictShlibs:
+            raise MirrorError(f"{len(unsatisfied)} packages require shared libraries the mirror does not provide{hint}")
+        print(f"{YELLOW}WARN{RESET}: {len(unsatisfied)} packages require shared libraries the mirror does not provide{hint}")
+    if (journal is not None) and (journaled is None):
+        journal.record("closure", closureKey, closure=closure, unknown=unknown)
+    print(f"{WHITE}Packages in closure{RESET}: {len(closure)} ({len(wanted)} selected)")
+    countMetric("packages_in_closure", len(closure))
+    countMetric("packages_unknown", len(unknown))
+    countMetric("packages_unsatisfied_shlibs", len(unsatisfied))
+    return (closure, unknown, unsatisfied)
+
+def buildMirror( catalogue, closure, localRepoPath, isoFile=None, volumeID="FreeBSD", packingFormat="txz", keepRepoPath=False,
+                 directMode=False, forceVerify=False, skipUnknown=False, closeShlibs=False, volumeSize=None, storeGC=False,
+                 strictShlibs=False ):
     global RED
     global YELLOW
     global WHITE
     global GREEN
     global BLUE
     global RESET
-    newDeps = {}
-    unknownPackages = {}
-    willQuit = False
-    for p in currList:
-        # print(f"Searching for dependencies of {p}")
+    # Fetches the packages of closure into localRepoPath, writes the
+    # repository files and, with an isoFile, the ISO (or volumes of at most
+    # volumeSize bytes). Returns the packages that made it into the mirror.
+    if directMode and (isoFile is None):
+        raise MirrorError("direct mode needs an ISO file")
+    checkPackingFormat(packingFormat)
+    allPkg = catalogue.allPkg
+    config = catalogue.config
+    os.makedirs(localRepoPath, exist_ok=True)
+    journal = config.openJournal(localRepoPath, forceVerify)
+
+    beginPhase("sync")
+    print(f"{WHITE}Synchronizing packages...{RESET}")
+    synced = syncPackages(allPkg, list(closure), localRepoPath, config, forceVerify)
+    if len(synced) != len(closure):
+        # a mirror without them would install with broken dependencies; what
+        # was fetched is journaled, so running again only retries the rest
+        missing = sorted(set(closure) - set(synced))
+        raise MirrorError(f"{len(missing)} packages are missing from the mirror: " + ", ".join(missing[:10])
+                          + (", ..." if len(missing) > 10 else ""))
+
+    if directMode:
+        # packages stay in the repo path, only generated files are staged
+        siteDir = tempfile.mkdtemp(prefix="repo2repo.")
+    else:
+        siteDir = localRepoPath
+
+    # generated files only change when their inputs do; the journal start
+    # time is their timestamp, so regenerating them gives the same bytes
+    beginPhase("manifest")
+    # manifest lines are written back exactly as the catalogue had them
+    manifestKey = writeRepoManifest(siteDir, [ allPkg[p].line for p in synced ], packingFormat, journal, g_zstdLevel)
+
+    beginPhase("bootstrap")
+    bootstrapKey = journalKey(allPkg["pkg"].sum, g_pkg_conf, g_mirror)
+    if journal.done("bootstrap", bootstrapKey) and os.path.exists(siteDir+"/pkg-bootstrap.tgz"):
+        print(f"{WHITE}pkg-bootstrap.tgz is up to date{RESET}")
+    else:
+        print(f"{WHITE}Preparing pkg for bootstraping...{RESET}")
+        pkgFile = os.path.abspath(localRepoPath+"/"+allPkg["pkg"].repopath)
+        buildBootstrap(siteDir, pkgFile, journal.startTime)
+        journal.record("bootstrap", bootstrapKey)
+
+    beginPhase("iso")
+    if not isoFile is None:
+        if volumeSize is not None:
+            roots = [ p for p in closure if closure[p] is None ]
+            (volumes, split) = splitVolumes(allPkg, synced, roots, volumeSize, catalogue.shlibIndex if closeShlibs else None)
+            for r in split:
+                print(f"{YELLOW}WARN{RESET}: {WHITE}{r}{RESET} and its dependencies do not fit on one volume, they are spread over several")
+        else:
+            volumes = [ synced ]
+        # what is checked is exactly what goes on each ISO, packages that
+        # could not be fetched included
+        broken = 0
+        for n, names in enumerate(volumes, 1):
+            missing = catalogue.shlibIndex.unsatisfied(names)
+            reportShlibs(missing, closure, f" on volume {n}" if len(volumes) > 1 else "")
+            broken += len(missing)
+        if (broken != 0) and strictShlibs:
+            raise MirrorError("shared libraries are missing from the ISO, nothing was written")
+    if (not isoFile is None) and (volumeSize is not None):
+        print(f"{WHITE}Volumes{RESET}: {len(volumes)} ({sum([ len(v) for v in volumes ])-len(synced)} packages repeated on more than one)")
+        writeVolumes(allPkg, volumes, localRepoPath, siteDir, isoFile, volumeID, packingFormat, journalKey(manifestKey, bootstrapKey), journal)
+    elif not isoFile is None:
+        isoKey = journalKey(manifestKey, bootstrapKey, [ allPkg[p].sum for p in synced ], volumeID, directMode)
+        if journal.done("iso", isoKey) and os.path.exists(isoFile):
+            print(f"{WHITE}ISO file is up to date{RESET}: {isoFile}")
+        else:
+            print(f"{WHITE}Generating ISO file{RESET}: {isoFile}")
+            if directMode:
+                graftList = siteDir + ".graft"
+                writeGraftList(graftList, [ (allPkg[p].repopath, os.path.realpath(localRepoPath+"/"+allPkg[p].repopath)) for p in synced ])
+                writeISO(isoFile, siteDir, volumeID, graftList)
+                os.remove(graftList)
+            else:
+                writeISO(isoFile, localRepoPath, volumeID, exclude=[ g_stateFile, g_journalFile, "*.part" ])
+            journal.record("iso", isoKey)
+    if not isoFile is None:
+        if directMode:
+            shutil.rmtree(siteDir)
+        elif not keepRepoPath:
+            print(f"{WHITE}Deleting {localRepoPath}{RESET}")
+            runCommand(f"rm -rf {localRepoPath}")
+
+    if storeGC and (config.storeDir is not None):
+        beginPhase("gc")
+        collectStoreGarbage(config.storeDir)
+
+    journal.finish()
+    config.journal = None
+    return synced
+
+class ReplyWriter(io.TextIOBase):
+    # stdout of a build run by the daemon: every complete line goes to the
+    # client as {"log": line}. A client that went away does not stop the
+    # build, its output is dropped.
+    def __init__( self, wfile ):
+        self.wfile = wfile
+        self.pending = ""
+
+    def write( self, text ):
+        self.pending += text
+        while "\n" in self.pending:
+            line, self.pending = self.pending.split("\n", 1)
+            self.send({ "log": line })
+        return len(text)
+
+    def send( self, reply ):
+        if self.wfile is None:
+            return
         try:
-            thisPkg = None
-            try:
-                thisPkg = allPkg[p]
-            except Exception as e:
-                print(f"{YELLOW}WARN{RESET}: unknown package {WHITE}{p}{RESET}")
-                unknownPackages[p] = 1
-                if skipUnknown==False: willQuit = True
-            if thisPkg is not None:
-                dp = thisPkg.get("deps",{})
-                for dpn in dp:
-                    if dpn not in currList:
-                        newDeps[dpn] = 1
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+        except OSError:
+            self.wfile = None
+
+class MirrorRequestHandler(socketserver.StreamRequestHandler):
+    def handle( self ):
+        out = ReplyWriter(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline())
+            # builds share the catalogue and its MirrorConfig, they run one
+            # at a time and never while the catalogue is being refreshed
+            with self.server.lock, contextlib.redirect_stdout(out):
+                reply = self.server.build(request)
+        except MirrorError as e:
+            reply = { "status": "error", "message": str(e) }
         except Exception as e:
-            print(f"{YELLOW}WARN{RESET}: unknown package {WHITE}{p}{RESET} - " + str(e))
-            unknownPackages[p] = 1
-            if skipUnknown==False: willQuit = True
-    if willQuit:
-        exit(0)
-    return (newDeps, unknownPackages)
+            reply = { "status": "error", "message": f"{type(e).__name__}: {e}" }
+        if out.pending != "":
+            out.write("\n")
+        out.send(reply)
+
+class MirrorDaemon(socketserver.UnixStreamServer):
+    # Answers "build a mirror for this selection" requests on a local
+    # socket with the catalogue and its indexes kept in memory, refreshed
+    # every refreshInterval seconds. A request is one line holding a JSON
+    # object (see requestBuild()); the reply streams the build output as
+    # {"log": line} lines and ends with a {"status": "ok", ...} or
+    # {"status": "error", "message": ...} line.
+    def __init__( self, socketPath, catalogue, refreshInterval ):
+        self.socketPath = socketPath
+        self.catalogue = catalogue
+        self.refreshInterval = refreshInterval
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)           # left behind by an earlier daemon
+        socketserver.UnixStreamServer.__init__(self, socketPath, MirrorRequestHandler)
+        os.chmod(socketPath, 0o600)
+        self.refresher = threading.Thread(target=self.refreshLoop, daemon=True)
+        self.refresher.start()
+
+    def refreshLoop( self ):
+        global RED
+        global YELLOW
+        global WHITE
+        global GREEN
+        global BLUE
+        global RESET
+        while not self.stopEvent.wait(self.refreshInterval):
+            with self.lock:
+                try:
+                    if self.catalogue.refresh():
+                        print(f"{WHITE}Catalogue updated{RESET}: {len(self.catalogue.allPkg)} packages")
+                except MirrorError as e:
+                    print(f"{YELLOW}WARN{RESET}: {e}, keeping the catalogue loaded at {time.ctime(self.catalogue.refreshTime)}")
+
+    def build( self, request ):
+        startTime = time.perf_counter()
+        mirrorlib.g_metrics = RunMetrics("repo2repo")
+        wanted = selectWanted(self.catalogue, request["selection"])
+        (closure, unknown, unsatisfied) = resolvePackages(self.catalogue, wanted, request.get("skipUnknown", False), request.get("shlibs", False),
+                                                          request.get("strictShlibs", False))
+        synced = buildMirror(self.catalogue, closure, request["repo"],
+                             isoFile       = request.get("iso"),
+                             volumeID      = request.get("volumeID", "FreeBSD"),
+                             packingFormat = request.get("format", "txz"),
+                             keepRepoPath  = request.get("keep", False),
+                             directMode    = request.get("direct", False),
+                             forceVerify   = request.get("verify", False),
+                             skipUnknown   = request.get("skipUnknown", False),
+                             closeShlibs   = request.get("shlibs", False),
+                             volumeSize    = request.get("volumeSize"),
+                             storeGC       = request.get("gc", False),
+                             strictShlibs  = request.get("strictShlibs", False))
+        return { "status"    : "ok",
+                 "catalogue" : self.catalogue.key,
+                 "closure"   : len(closure),
+                 "packages"  : len(synced),
+                 "unknown"   : list(unknown),
+                 "seconds"   : time.perf_counter() - startTime,
+                 "metrics"   : mirrorlib.g_metrics.report() }
+
+    def server_close( self ):
+        self.stopEvent.set()
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+def requestBuild( socketPath, request ):
+    # Sends a build request to the daemon on socketPath and prints its output
+    # as it arrives; returns the final reply. request holds "selection" (the
+    # lines of a selection list) and "repo" (absolute path), and optionally
+    # "iso", "volumeID", "format", "keep", "direct", "verify", "skipUnknown",
+    # "shlibs", "strictShlibs", "volumeSize" and "gc", as the matching
+    # options do.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socketPath)
+        f = s.makefile("rwb")
+        f.write(json.dumps(request).encode() + b"\n")
+        f.flush()
+        for line in f:
+            reply = json.loads(line)
+            if "log" in reply:
+                print(reply["log"], flush=True)
+            else:
+                return reply
+    return { "status": "error", "message": "the daemon closed the connection" }
 
 def help():
     global RED
@@ -251,22 +1849,64 @@ def help():
     print("repo2repo: create a local mirror of a FreeBSD repository")
     print("")
     print("  -u <URL>       : example http://pkg.freebsd.org/FreeBSD:14:amd64/latest/")
+    print("                   may be repeated to download from several mirrors")
+    print("  -R <retries>   : download retries per package, across mirrors [default = 4]")
     print("  -r <path>      : local path to store the repository [default = repo]")
     print("  -v <version>   : FreeBSD version [default = 14]")
     print("  -c <cpu>       : CPU type, e.g. amd64, aarch64 [default = amd64]")
     print("  -e <endpoint>  : repository endpoint, e.g. latest, release_2 [default = quarterly]]")
     print("  -i <file.iso>  : output ISO file [default = None]]")
-    print("  -l <selected>  : list of selected packages")
+    print("  -l <selected>  : list of selected packages, one per line; a line may also")
+    print("                   select by glob (py311-*), regular expression (~py3[0-9]+-.*)")
+    print("                   or field (origin:www/nginx, category:databases, flavor:py311,")
+    print("                   name:...), terms on one line must all match, and a leading")
+    print("                   ! excludes what the line matches [default = selected.txt]")
+    print("  -p <plan.json> : plan only: resolve the selection, report what is cached, what")
+    print("                   would be fetched and the ISO size, and save the plan; nothing")
+    print("                   but the catalogue is downloaded")
+    print("  -x <plan.json> : execute a saved plan: its mirrors, catalogue, closure, packing")
+    print("                   format, volume ID and volume size are used as they were planned")
     print("  -V <volume_ID> : volume ID for the ISO file")
+    print("  -z <format>    : catalogue packing format, txz or tzst [default = txz]")
+    print("  -M <size>      : split the ISO into volumes of at most <size> bytes (K, M, G")
+    print("                   suffixes allowed); every volume is a complete repository")
+    print("                   holding the dependencies of its packages, name.iso becomes")
+    print("                   name-1.iso, name-2.iso, ...")
     print("  -k             : keep repo path")
+    print("  -d             : direct mode, graft packages from the repo path into the ISO;")
+    print("                   generated files are staged separately and the repo path is kept")
+    print("  -j <workers>   : number of parallel downloads [default = 8]")
     print("  -s             : skip unknown packages")
+    print("  -E             : stop when a package requires a shared library the mirror")
+    print("                   does not provide, instead of only warning")
+    print("  -D             : also add a provider of every shared library a package")
+    print("                   requires (shlibs_required) to the closure")
+    print("  -w             : show why each package is part of the closure")
+    print("  -F             : re-verify the checksum of every local package and")
+    print("                   start over instead of resuming an interrupted run")
+    print("  -S <dir>       : shared content-addressed package store, mirrors are")
+    print("                   assembled from it with hardlinks [default = None]")
+    print("  -G             : garbage collect the store after the run")
+    print("  -L <dir>       : local directory to seed packages from, may be repeated;")
+    print("                   \"none\" disables seeding [default = /var/cache/pkg]")
+    print("  -C <dir>       : catalogue cache directory, \"none\" to disable")
+    print("                   [default = ~/.cache/repo2repo]")
+    print("  -q             : quiet downloads, no per-file output or progress bar")
+    print("  -T <file.json> : write per-phase timings, counters and peak memory as JSON")
+    print("  -P <file.prom> : write the same metrics as a Prometheus textfile")
     print("  -n             : no color")
     print("")
+    print("  --daemon <sock>  : run as a daemon: keep the catalogue in memory and build")
+    print("                     mirrors for the requests received on the unix socket")
+    print("                     <sock>; -u, -v, -c, -e, -j, -R, -S, -L, -C and -q apply")
+    print("                     to the daemon, everything else comes with each request")
+    print("  --refresh <secs> : how often the daemon refreshes the catalogue [default = 300]")
+    print("  --connect <sock> : have the daemon on <sock> build the mirror described by")
+    print("                     -l, -r, -i, -V, -z, -M, -k, -d, -s, -D, -F and -G")
+    print("")
 
 def main():
     global g_verboseMode 
-    global g_meta
-    global g_mirror
     global g_pkg_conf
     global RED
     global YELLOW
@@ -279,21 +1919,43 @@ def main():
     endpoint = "quarterly"
     localRepoPath = "repo"
     selectedListFileName = "selected.txt"
-    forceRepoURL = None
+    forceRepoURLs = []
     isoFile = None
     keepRepoPath = False
+    directMode = False
+    packingFormat = "txz"
     skipUnknown = False
+    closeShlibs = False
+    strictShlibs = False
+    forceVerify = False
+    whyMode = False
+    storeGC = False
+    workers = g_workers
+    retries = g_retries
+    storeDir = None
+    catalogueCacheDir = g_catalogueCacheDir
+    quietMode = False
+    localSourceDirs = []
     useColor = True
     volumeID = "FreeBSD"
     setVolID = None
+    planFile = None
+    executePlanFile = None
+    volumeSize = None
+    metricsFile = None
+    prometheusFile = None
+    daemonSocket = None
+    connectSocket = None
+    refreshInterval = 300
+    plan = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "u:hr:v:c:e:i:ksl:nV:")
+        opts, args = getopt.getopt(sys.argv[1:], "u:hr:v:c:e:i:ksl:nV:j:FwC:dz:S:GL:R:qp:x:M:T:P:DE", ["plan=", "execute=", "daemon=", "connect=", "refresh="])
     except getopt.GetoptError as err:
         help()
         exit(2)
     for o, a in opts:
-        if   o in ("-u"): forceRepoURL = a
+        if   o in ("-u"): forceRepoURLs.append(a)
         elif o in ("-r"): localRepoPath = a
         elif o in ("-v"): version = a
         elif o in ("-V"): setVolID = a
@@ -302,8 +1964,29 @@ def main():
         elif o in ("-i"): isoFile = a
         elif o in ("-l"): selectedListFileName = a
         elif o in ("-k"): keepRepoPath = True
+        elif o in ("-d"): directMode = True
+        elif o in ("-z"): packingFormat = a
         elif o in ("-s"): skipUnknown = True
+        elif o in ("-D"): closeShlibs = True
+        elif o in ("-E"): strictShlibs = True
+        elif o in ("-j"): workers = int(a)
+        elif o in ("-R"): retries = int(a)
+        elif o in ("-F"): forceVerify = True
+        elif o in ("-w"): whyMode = True
+        elif o in ("-S"): storeDir = a
+        elif o in ("-G"): storeGC = True
+        elif o in ("-L"): localSourceDirs.append(a)
+        elif o in ("-C"): catalogueCacheDir = None if a == "none" else a
         elif o in ("-n"): useColor = False
+        elif o in ("-q"): quietMode = True
+        elif o in ("-p", "--plan"): planFile = a
+        elif o in ("-M"): volumeSize = a
+        elif o in ("-T"): metricsFile = a
+        elif o in ("-P"): prometheusFile = a
+        elif o in ("-x", "--execute"): executePlanFile = a
+        elif o == "--daemon": daemonSocket = a
+        elif o == "--connect": connectSocket = a
+        elif o == "--refresh": refreshInterval = int(a)
         elif o in ("-h"):
             help()
             exit(0)
@@ -317,115 +2000,239 @@ def main():
         GREEN  = ""
         BLUE   = ""
         RESET  = ""
+        mirrorlib.noColor()
 
     if os.path.exists(localRepoPath):
         if not os.path.isdir(localRepoPath):
             print(f"{RED}ERROR{RESET}: destination path ({localRepoPath}) is not a directory!")
             exit(0)
 
-    if not os.path.exists(localRepoPath):
+    # planning only reads the repo path, it is not created; a daemon gets
+    # the repo path with every request
+    makeRepoPath = (planFile is None) and (daemonSocket is None) and (connectSocket is None)
+    if (not os.path.exists(localRepoPath)) and makeRepoPath:
         os.system(f"mkdir {localRepoPath}")
 
     if os.path.exists(localRepoPath):
         if not os.path.isdir(localRepoPath):
             print(f"{RED}ERROR{RESET}: unknown error in repo path creation!")
             exit(0)
-    else:
+    elif makeRepoPath:
         print(f"{RED}ERROR{RESET}: could not create destination path ({localRepoPath})")
         exit(0)
 
-    if forceRepoURL is None:
-        repoURL = f"https://pkg.FreeBSD.org/FreeBSD:{version}:{cpuType}/{endpoint}"
+    if (daemonSocket is not None) and ((planFile is not None) or (executePlanFile is not None) or (connectSocket is not None)):
+        print(f"{RED}ERROR{RESET}: a daemon (--daemon) cannot plan (-p), execute a plan (-x) or connect to another daemon (--connect)")
+        exit(0)
+
+    if (connectSocket is not None) and ((planFile is not None) or (executePlanFile is not None)):
+        print(f"{RED}ERROR{RESET}: plans (-p, -x) are made and executed locally, not through a daemon (--connect)")
+        exit(0)
+
+    if (planFile is not None) and (executePlanFile is not None):
+        print(f"{RED}ERROR{RESET}: a plan (-p) cannot be made while executing one (-x)")
+        exit(0)
+
+    if executePlanFile is not None:
+        plan = loadPlan(executePlanFile)
+        if plan is None:
+            print(f"{RED}ERROR{RESET}: unable to load plan {executePlanFile}")
+            exit(0)
+        print(f"{WHITE}Executing plan{RESET}: {executePlanFile}")
+        if forceRepoURLs == []:
+            forceRepoURLs = plan["mirrors"]
+        packingFormat = plan["packingFormat"]
+        skipUnknown = plan["skipUnknown"]
+        closeShlibs = plan.get("shlibs", False)
+        strictShlibs = plan.get("strictShlibs", False)
+
+    if forceRepoURLs == []:
+        repoURLs = [ f"https://pkg.FreeBSD.org/FreeBSD:{version}:{cpuType}/{endpoint}" ]
     else:
-        repoURL = forceRepoURL
+        repoURLs = forceRepoURLs
 
-    if not os.path.exists(selectedListFileName):
+    try:
+        checkPackingFormat(packingFormat)
+    except MirrorError as e:
+        print(f"{RED}ERROR{RESET}: {e}")
+        exit(0)
+
+    if localSourceDirs == []:
+        localSourceDirs = [ "/var/cache/pkg" ]
+    localSources = [ DirectorySource(d) for d in localSourceDirs if (d != "none") and os.path.isdir(d) ]
+    if "none" in localSourceDirs:
+        localSources = []
+
+    if storeGC and (storeDir is None):
+        print(f"{RED}ERROR{RESET}: garbage collection (-G) needs a store (-S)")
+        exit(0)
+
+    if directMode and (isoFile is None):
+        print(f"{RED}ERROR{RESET}: direct mode (-d) needs an ISO file (-i)")
+        exit(0)
+
+    if volumeSize is not None:
+        try:
+            volumeSize = parseSize(volumeSize)
+        except ValueError:
+            print(f"{RED}ERROR{RESET}: invalid volume size ({volumeSize})")
+            exit(0)
+        if (isoFile is None) and (planFile is None):
+            print(f"{RED}ERROR{RESET}: splitting into volumes (-M) needs an ISO file (-i)")
+            exit(0)
+    if plan is not None:
+        # the plan promised its volumes, a different -M would not give them
+        if (volumeSize is not None) and (volumeSize != plan.get("volumeSize")):
+            print(f"{RED}ERROR{RESET}: -M does not match the volume size of the plan, run it without -M or make a new plan")
+            exit(0)
+        volumeSize = plan.get("volumeSize")
+
+    # the catalogue carries the download options to every build made from it
+    catalogue = Catalogue(repoURLs, workers=workers, retries=retries, storeDir=storeDir, localSources=localSources,
+                          catalogueCacheDir=catalogueCacheDir, quiet=quietMode)
+
+    if daemonSocket is not None:
+        try:
+            catalogue.refresh()
+        except MirrorError as e:
+            print(f"{RED}ERROR{RESET}: {e}")
+            exit(0)
+        server = MirrorDaemon(daemonSocket, catalogue, refreshInterval)
+        print(f"{WHITE}Serving on{RESET}: {daemonSocket} ({len(catalogue.allPkg)} packages, refreshed every {refreshInterval}s)")
+        def stop( signum, frame ):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        exit(0)
+
+    if (plan is None) and (not os.path.exists(selectedListFileName)):
         print(f"{RED}ERROR{RESET}: unable to open file {selectedListFileName}")
         exit(0)
 
-    if not setVolID is None:
+    if plan is not None:
+        volumeID = plan["volumeID"]
+    elif not setVolID is None:
         volumeID = setVolID
     else:
         volumeID = volumeID + "_" + cpuType
 
-    url = repoURL+"/packagesite.txz"
+    if connectSocket is not None:
+        # the daemon does the work, paths are sent as it has to see them
+        request = { "selection"   : list(loadWantedPkg(selectedListFileName)),
+                    "repo"        : os.path.abspath(localRepoPath),
+                    "iso"         : os.path.abspath(isoFile) if isoFile is not None else None,
+                    "volumeID"    : volumeID,
+                    "format"      : packingFormat,
+                    "keep"        : keepRepoPath,
+                    "direct"      : directMode,
+                    "verify"      : forceVerify,
+                    "skipUnknown" : skipUnknown,
+                    "shlibs"      : closeShlibs,
+                    "strictShlibs": strictShlibs,
+                    "volumeSize"  : volumeSize,
+                    "gc"          : storeGC }
+        try:
+            reply = requestBuild(connectSocket, request)
+        except OSError as e:
+            print(f"{RED}ERROR{RESET}: could not reach the daemon on {connectSocket} - "+str(e))
+            exit(1)
+        if reply["status"] != "ok":
+            print(f"{RED}ERROR{RESET}: {reply['message']}")
+            exit(1)
+        print(f"{WHITE}Mirror built in{RESET}: {reply['seconds']:.1f}s ({reply['packages']} packages)")
+        print(f"{GREEN}Done.{RESET}")
+        exit(0)
 
-    print(f"{WHITE}Getting list of packages from{RESET}: {url}")
-    allPkg = loadPackageListFromURL(url)
+    journal = None
+    if planFile is None:
+        journal = catalogue.config.openJournal(localRepoPath, forceVerify)
 
-    print(f"{WHITE}Getting list of wanted packages from{RESET}: {selectedListFileName}")
-    wp = loadWantedPkg(selectedListFileName)
-    pkgToDownload = dict(wp)
-    pkgToDownload["pkg"] = 1
+    mirrorlib.g_metrics = RunMetrics("repo2repo")
+    try:
+        beginPhase("catalogue")
+        catalogue.refresh()
+        allPkg = catalogue.allPkg
+        if (plan is not None) and (plan["catalogue"] != catalogue.key):
+            raise MirrorError("the catalogue changed since the plan was made, make a new plan")
+        if (journal is not None) and (not journal.done("catalogue", catalogue.key)):
+            journal.record("catalogue", catalogue.key, url=catalogue.url, packages=len(allPkg))
 
-    print(f"{WHITE}Generating list of packages to fetch...{RESET}")
-    firstPass = True
-    while True:
-        if firstPass and skipUnknown:
-            (np, unk) = getNewDeps(pkgToDownload, allPkg, True)
-        else:
-            (np, unk) = getNewDeps(pkgToDownload, allPkg, False)
-        if np != {}:
-            for p in np: pkgToDownload[p] = 1
-        for u in unk:
-            del pkgToDownload[u]
+        if plan is not None:
+            wp = plan["selected"]
+            planned = (plan["closure"], plan["unknown"])
         else:
-            break
+            print(f"{WHITE}Getting list of wanted packages from{RESET}: {selectedListFileName}")
+            wp = selectWanted(catalogue, loadWantedPkg(selectedListFileName), selectedListFileName)
+            planned = None
 
-    localPaths = []
-    print(f"{WHITE}Downloading packages...{RESET}")
-    for p in pkgToDownload:
-        repoPath = allPkg[p]["repopath"]
-        fileURL = repoURL+"/" + repoPath
-        fileName = localRepoPath + "/" + repoPath
-        localPath = os.path.dirname(os.path.realpath(fileName))
-        if localPath not in localPaths:
-            localPaths.append(localPath)
-            os.system(f"mkdir {localPath} 2> /dev/null > /dev/null")
-        print(f"{BLUE}{fileURL}{RESET} -> {YELLOW}{fileName}{RESET} : ", end="", flush=True )
-        if getFileSize(fileName) != allPkg[p]["pkgsize"]:
-            fileContents = fetchURL(fileURL)
-            with open(fileName,"wb") as f:
-                f.write(fileContents)
-            with open(localRepoPath+"/packagesite.yaml","a") as f:
-                f.write(json.dumps(allPkg[p]))
-                f.write("\n")
-            print(f"{GREEN}OK{RESET}")
-        else:
-            print(f"{WHITE}CACHED{RESET}")
-
-    print(f"{WHITE}Generating meta.conf...{RESET}")
-    with open(localRepoPath+"/"+"meta.conf","w") as f:
-        f.write(g_meta)
-
-    print(f"{WHITE}Generating packagesite.txz...{RESET}")
-    os.system(f"cd {localRepoPath}; bsdtar -cvof packagesite.txz packagesite.yaml > /dev/null 2> /dev/null")
-
-    print(f"{WHITE}Generating packagesite.pkg...{RESET}")
-    os.system(f"cd {localRepoPath}; cp packagesite.txz packagesite.pkg")
-
-    print(f"{WHITE}Preparing pkg for bootstraping...{RESET}")
-    os.system(f"mkdir -p {localRepoPath}/.tmp")
-    os.system(f"cd {localRepoPath}/.tmp; tar xzf ../{allPkg['pkg']['repopath']} 2> /dev/null")
-    os.system(f"mkdir -p {localRepoPath}/.bootstrap")
-    os.system(f"mkdir -p {localRepoPath}/.bootstrap/usr/local/sbin/; cp {localRepoPath}/.tmp/usr/local/sbin/pkg {localRepoPath}/.bootstrap/usr/local/sbin/pkg")
-    os.system(f"mkdir -p {localRepoPath}/.bootstrap/usr/local/sbin/; cp {localRepoPath}/.tmp/usr/local/sbin/pkg-static {localRepoPath}/.bootstrap/usr/local/sbin/pkg-static")
-    os.system(f"mkdir -p {localRepoPath}/.bootstrap/usr/local/etc")
-    with open(localRepoPath+"/.bootstrap/usr/local/etc/pkg.conf","w") as f:
-        f.write(g_pkg_conf)
-    os.system(f"mkdir -p {localRepoPath}/.bootstrap/etc/pkg/")
-    with open(localRepoPath+"/.bootstrap/etc/pkg/mirror.conf","w") as f:
-        f.write(g_mirror)
-    os.system(f"cd {localRepoPath}/.bootstrap; tar cvzf ../pkg-bootstrap.tgz etc usr")
-    os.system(f"rm -rf {localRepoPath}/.bootstrap")
-    os.system(f"rm -rf {localRepoPath}/.tmp")
+        (pkgToDownload, unknown, unsatisfied) = resolvePackages(catalogue, wp, skipUnknown, closeShlibs, strictShlibs, planned)
+        if whyMode:
+            for p in pkgToDownload:
+                print(f"{BLUE}{p}{RESET}: {' <- '.join(whyPackage(p, pkgToDownload)[1:]) or 'selected'}")
 
-    if not isoFile is None:
-        print(f"{WHITE}Generating ISO file{RESET}: {isoFile}")
-        os.system(f"mkisofs -R -V {volumeID} -UDF -o {isoFile} {localRepoPath}")
-        if not keepRepoPath:
-            print(f"{WHITE}Deleting {localRepoPath}{RESET}")
-            os.system(f"rm -rf {localRepoPath}")
+        if planFile is not None:
+            beginPhase("plan")
+            status = planPackages(allPkg, list(pkgToDownload), localRepoPath, catalogue.config)
+            counts = collections.Counter()
+            sizes = collections.Counter()
+            for p in pkgToDownload:
+                counts[status[p]] += 1
+                sizes[status[p]] += allPkg[p].pkgsize
+                print(f"  {BLUE}{p:40s}{RESET} {allPkg[p].pkgsize/(1024*1024):10.2f} MiB  {status[p]}")
+            isoSize = estimateISOSize(allPkg, list(pkgToDownload))
+            cachedBytes = sum([ sizes[s] for s in ("current", "verify", "store", "local") ])
+            print(f"{WHITE}Plan{RESET}: {len(pkgToDownload)} packages, {len(unknown)} unknown")
+            for s, label in (("current","up to date"), ("verify","on disk, to verify"), ("store","in store"), ("local","in local sources"), ("fetch","to fetch")):
+                print(f"  {label:20s}: {counts[s]:6d} packages, {sizes[s]/(1024*1024):10.1f} MiB")
+            print(f"  {'cached':20s}: {cachedBytes/(1024*1024):29.1f} MiB")
+            print(f"  {'projected ISO size':20s}: {isoSize/(1024*1024):29.1f} MiB")
+            volumeSizes = []
+            if volumeSize is not None:
+                roots = [ p for p in pkgToDownload if pkgToDownload[p] is None ]
+                (volumes, split) = splitVolumes(allPkg, list(pkgToDownload), roots, volumeSize, catalogue.shlibIndex if closeShlibs else None)
+                volumeSizes = [ estimateISOSize(allPkg, names) for names in volumes ]
+                print(f"  {'volumes':20s}: {len(volumes):6d}, {' + '.join([ f'{s/(1024*1024):.1f}' for s in volumeSizes ])} MiB")
+            savePlan(planFile, { "version"       : 1,
+                                 "created"       : int(time.time()),
+                                 "mirrors"       : repoURLs,
+                                 "catalogue"     : catalogue.key,
+                                 "selected"      : list(wp),
+                                 "skipUnknown"   : skipUnknown,
+                                 "shlibs"        : closeShlibs,
+                                 "strictShlibs"  : strictShlibs,
+                                 "packingFormat" : packingFormat,
+                                 "volumeID"      : volumeID,
+                                 "closure"       : pkgToDownload,
+                                 "unknown"       : unknown,
+                                 "unsatisfied"   : unsatisfied,
+                                 "packages"      : { p: { "repopath": allPkg[p].repopath,
+                                                          "pkgsize" : allPkg[p].pkgsize,
+                                                          "sum"     : allPkg[p].sum,
+                                                          "status"  : status[p] } for p in pkgToDownload },
+                                 "bytes"         : { "cached": cachedBytes, "fetch": sizes["fetch"] },
+                                 "isoSize"       : isoSize,
+                                 "volumeSize"    : volumeSize,
+                                 "volumeSizes"   : volumeSizes })
+            print(f"{WHITE}Plan saved to{RESET}: {planFile}")
+            print(f"{GREEN}Done.{RESET}")
+            exit(0)
+
+        buildMirror(catalogue, pkgToDownload, localRepoPath, isoFile, volumeID, packingFormat, keepRepoPath,
+                    directMode, forceVerify, skipUnknown, closeShlibs, volumeSize, storeGC, strictShlibs)
+    except MirrorError as e:
+        mirrorlib.g_metrics.fail(str(e))
+        print(f"{RED}ERROR{RESET}: {e}")
+        exit(e.status)
+    except Exception as e:
+        mirrorlib.g_metrics.fail(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        # failed runs are the ones worth looking at, they are written too
+        writeMetrics(metricsFile, prometheusFile)
 
     print(f"{GREEN}Done.{RESET}")
 